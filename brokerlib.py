@@ -25,7 +25,7 @@ from session import Session, SessionError, FIXED
 from link import LinkError, Receiver, Sender, link
 from util import ConnectionSelectable
 from protocol import Source, Target, Coordinator, Declare, Declared, Discharge, \
-    TransactionalState, ACCEPTED, Binary
+    TransactionalState, ACCEPTED, Binary, AmqpValue
 from messaging import decode
 from queue import Queue
 
@@ -85,7 +85,7 @@ class TxnTarget:
     return True
 
   def put(self, dtag, xfr, owner=None):
-    msg = decode(xfr)
+    msg = decode(xfr, (AmqpValue,))
     return self.dispatch[msg.content.__class__](xfr.state, msg)
 
   def declare(self, state, msg):
@@ -143,6 +143,27 @@ class Broker:
                       Source: self.resolve_source,
                       Coordinator: self.resolve_coordinator}
 
+    self.coalesce = 0
+    # None leaves it to ConnectionSelectable
+    self.delay = None
+    # stop sending messages while this many bytes wait to be written
+    self.backlog = 0
+    # Links are only visited when their peer has done something to them
+    # (see Connection.activity), or when they are blocked, i.e. senders
+    # with credit and nothing to send and receivers held back by a full
+    # target, and a node may have changed since. Which connection
+    # changed a node doesn't matter, it's enough to know one did.
+    self.blocked = set()
+    self.changed = False
+    # connection ticks that found work or had none, and how many links
+    # they visited or had no reason to
+    self.ticks = 0
+    self.skipped = 0
+    self.links_ticked = 0
+    self.links_skipped = 0
+    # a capture.Capture that every connection records into
+    self.capture = None
+
     self.sock = None
     self.listener = None
 
@@ -162,13 +183,21 @@ class Broker:
   def writing(self):
     return False
 
-  def timing(self):
-    return None
+  def registered(self, selector):
+    pass
 
   def readable(self, selector):
     sock, addr = self.sock.accept()
+    sel = self.connection()
+    selector.register(ConnectionSelectable(sock, sel, self.tick, self.period,
+                                           self.timeout, self.coalesce,
+                                           self.delay))
+
+  def connection(self):
     conn = Connection(lambda properties: Session(link, properties))
     conn.tracing(*self.traces)
+    if self.backlog:
+      conn.throttle(self.backlog, resume=self.wake)
     if self.auth:
       sasl = SASL(conn)
       sasl.tracing(*self.traces)
@@ -176,10 +205,13 @@ class Broker:
       sel = sasl
     else:
       sel = conn
-    selector.register(ConnectionSelectable(sock, sel, self.tick, self.period,
-                                           self.timeout))
+    if self.capture is not None:
+      sel.capturing(self.capture)
+    return sel
 
   def timeout(self, connection):
+    if self.auth:
+      connection = connection.connection
     for ssn in connection.incoming.values() + connection.outgoing.values():
       ssn.set_incoming_window(self.window, FIXED)
 
@@ -198,21 +230,36 @@ class Broker:
     else:
       self.amqp_tick(sasl.connection)
 
+  def wake(self):
+    self.changed = True
+
   def amqp_tick(self, connection):
     if connection.opening():
       connection.open(container_id = self.container_id,
                       channel_max = 65535, max_frame_size=self.frame_size)
 
-    # XXX
-    for ssn in connection.incoming.values():
-      if ssn.beginning():
-        ssn.begin()
-        if self.period:
-          ssn.set_incoming_window(self.window, FIXED)
-        else:
-          ssn.set_incoming_window(self.window)
-
-    for ssn in connection.outgoing.values():
+    if self.changed:
+      self.changed = False
+      blocked = self.blocked
+      self.blocked = set()
+      for link in blocked:
+        link.activate()
+
+    # a closing connection orphans everything, so visits everything
+    closing = connection.closing() or connection.is_closed()
+    if closing:
+      connection.activity()
+      sessions = connection.outgoing.values()
+    else:
+      sessions = connection.activity()
+      if not sessions:
+        self.skipped += 1
+        return
+    self.ticks += 1
+
+    for ssn in sessions:
+      if ssn.connection is not connection:
+        continue
       if ssn.beginning():
         ssn.begin()
         if self.period:
@@ -220,7 +267,13 @@ class Broker:
         else:
           ssn.set_incoming_window(self.window)
 
-      links = ssn.links.values()
+      if closing or ssn.ending():
+        ssn.activity()
+        links = ssn.links.values()
+      else:
+        links = list(ssn.activity())
+      self.links_ticked += len(links)
+      self.links_skipped += len(ssn.links) - len(links)
       senders = []
       receivers = []
       for link in links:
@@ -255,10 +308,14 @@ class Broker:
         if link.detaching():
           self.detach[link.role](link, connection)
           link.detach()
-        elif ssn.ending() or connection.closing() or connection.is_closed():
+          self.changed = True
+        elif ssn.ending() or closing:
           self.orphan[link.role](link, connection)
+          self.blocked.discard(link)
+          self.changed = True
 
         if link.detached():
+          self.blocked.discard(link)
           ssn.remove(link)
 
       if ssn.ending():
@@ -268,6 +325,11 @@ class Broker:
     if connection.closing():
       connection.close()
 
+    if connection.is_closed():
+      connection.trace("io", "BROKER TICKS: %s performed, %s skipped, "
+                       "links %s ticked, %s skipped", self.ticks, self.skipped,
+                       self.links_ticked, self.links_skipped)
+
     connection.tick()
 
   def attach_sender(self, link, connection):
@@ -348,9 +410,13 @@ class Broker:
     key = (connection.container_id, link.name)
     source = self.sources[key]
     while link.capacity() > 0:
+      if connection.paused():
+        self.blocked.add(link)
+        break
       tag, xfr = source.get()
       if xfr is None:
         link.drained()
+        self.blocked.add(link)
         break
       else:
         link.send(delivery_tag = tag, message_format = xfr.message_format,
@@ -364,6 +430,7 @@ class Broker:
         def doit(t=t, s=r.state):
           state = source.settle(t, r.state)
           link.settle(t, state)
+          self.changed = True
         def undo(t=t):
           pass
         if r.state:
@@ -380,6 +447,7 @@ class Broker:
     key = (connection.container_id, link.name)
     target = self.targets[key]
     xfr = link.get()
+    self.changed = True
     if not isinstance(target, TxnTarget):
       if xfr.state:
         txn = self.coordinator.get_transaction(xfr.state)
@@ -415,8 +483,13 @@ class Broker:
       elif r.settled and not isinstance(l.state, TransactionalState):
         state = target.settle(t, l.state)
         link.settle(t, state)
+        self.changed = True
 
-    if target.capacity() and link.credit() < 10: link.flow(10)
+    if link.credit() < 10:
+      if target.capacity():
+        link.flow(10)
+      else:
+        self.blocked.add(link)
 
   def orphan_sender(self, link, connection):
     key = (connection.container_id, link.name)
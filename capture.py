@@ -0,0 +1,119 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+# 
+#   http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+import os, socket, struct, time
+from util import Constant
+
+# A capture file starts with MAGIC, followed by one record for each
+# chunk of bytes a connection read or wrote: the time it was seen, the
+# connection it belongs to, which way it went and its length, followed
+# by the bytes themselves. A connection closing is recorded as an empty
+# CLOSED record.
+#
+# Every process appending to the file starts with a RUN record naming
+# the host and pid. Connection ids start over with each run, so a
+# connection is identified by its run and id together. Files from
+# before runs were recorded are read as a single run.
+
+OLD_MAGIC = "AMQPCAP\x01"
+MAGIC = "AMQPCAP\x02"
+RECORD = struct.Struct("!dIBI")
+
+INPUT = Constant("INPUT", 0)
+OUTPUT = Constant("OUTPUT", 1)
+CLOSED = Constant("CLOSED", 2)
+RUN = Constant("RUN", 3)
+
+DIRECTIONS = dict((d.value, d) for d in (INPUT, OUTPUT, CLOSED, RUN))
+
+class CaptureError(Exception):
+  pass
+
+# The offset just past the last complete record. Reads the headers
+# only, skipping over the bytes.
+
+def complete(file):
+  file.seek(0, 2)
+  size = file.tell()
+  file.seek(0)
+  if file.read(len(MAGIC)) not in (OLD_MAGIC, MAGIC):
+    raise CaptureError("not a capture file")
+  end = len(MAGIC)
+  while end + RECORD.size <= size:
+    file.seek(end)
+    length = RECORD.unpack(file.read(RECORD.size))[-1]
+    if end + RECORD.size + length > size:
+      break
+    end += RECORD.size + length
+  return end
+
+# The file must be opened for reading as well as appending ("a+b").
+
+class Capture:
+
+  def __init__(self, file):
+    self.file = file
+    # a file opened for appending may not start out at its end
+    file.seek(0, 2)
+    if file.tell() == 0:
+      file.write(MAGIC)
+    else:
+      # a process killed partway through a record leaves the rest of it
+      # missing, and what we append would be read as that rest
+      end = complete(file)
+      file.seek(0, 2)
+      if end < file.tell():
+        file.truncate(end)
+    self.next_id = 0
+    self.record(0, RUN, "%s:%s" % (socket.gethostname(), os.getpid()))
+
+  def identify(self):
+    id = self.next_id
+    self.next_id += 1
+    return id
+
+  def record(self, id, direction, bytes):
+    self.file.write(RECORD.pack(time.time(), id, direction.value, len(bytes)))
+    self.file.write(bytes)
+    # leave everything recorded so far behind, however the process ends
+    self.file.flush()
+
+# Yields (when, run, id, direction, bytes) for each record, where run
+# counts the RUN records seen so far. A truncated final record, left by
+# a process killed while writing it, ends the capture.
+
+def records(file):
+  if file.read(len(MAGIC)) not in (OLD_MAGIC, MAGIC):
+    raise CaptureError("not a capture file")
+  run = 0
+  while True:
+    hdr = file.read(RECORD.size)
+    if len(hdr) < RECORD.size:
+      break
+    when, id, direction, size = RECORD.unpack(hdr)
+    bytes = file.read(size)
+    if len(bytes) < size:
+      break
+    if direction not in DIRECTIONS:
+      raise CaptureError("unknown direction: %s" % direction)
+    direction = DIRECTIONS[direction]
+    if direction is RUN:
+      run += 1
+    else:
+      yield when, run, id, direction, bytes
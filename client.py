@@ -61,6 +61,19 @@ class Connection:
   def trace(self, *args, **kwargs):
     self.proto.trace(*args, **kwargs)
 
+  @synchronized
+  def idle(self):
+    return self.sasl.idle()
+
+  @synchronized
+  def heartbeat(self):
+    self.sasl.heartbeat()
+
+  @synchronized
+  def dump(self):
+    self.sasl.dump()
+    self.proto.dump()
+
   @synchronized
   def connect(self, host, port):
     self.sock = socket.socket()
@@ -79,6 +92,14 @@ class Connection:
   def read(self, n=None):
     return self.sasl.read(n)
 
+  @synchronized
+  def segments(self, limit=None, count=None):
+    return self.sasl.segments(limit, count)
+
+  @synchronized
+  def consume(self, n):
+    self.sasl.consume(n)
+
   @synchronized
   def write(self, bytes):
     self.sasl.write(bytes)
@@ -146,6 +167,7 @@ class Connection:
   def close(self):
     self.proto.close()
     self.ewait(lambda: self.proto.close_rcvd)
+    self.dump()
 
 class Session:
 
@@ -17,7 +17,7 @@
 # under the License.
 #
 
-import datetime, struct, time, uuid, cStringIO
+import array, datetime, inspect, struct, sys, uuid, cStringIO
 from util import pythonize, load_xml, identity, Constant
 
 class Type:
@@ -32,8 +32,11 @@ class Described(Type):
   def construct(self, factory, value):
     return factory.construct_described(self, value)
 
-  def encode(self, encoder, value):
-    return encoder.encode_described(self, value)
+  def encode(self, encoder, out, value):
+    return encoder.encode_described(out, self, value)
+
+  def compile(self, encoder):
+    return encoder.compile_described(self)
 
   def __hash__(self):
     return hash((self.descriptor, self.source))
@@ -55,8 +58,11 @@ class Primitive(Type):
   def construct(self, factory, value):
     return factory.construct_primitive(self, value)
 
-  def encode(self, encoder, value):
-    return encoder.encode_primitive(self, value)
+  def encode(self, encoder, out, value):
+    return encoder.encode_primitive(out, self, value)
+
+  def compile(self, encoder):
+    return encoder.compile_primitive(self)
 
   def __hash__(self):
     return hash(self.name)
@@ -100,12 +106,13 @@ class Symbol:
 
   def __init__(self, name):
     self.name = name
+    self.hash = hash(name)
 
   def __hash__(self):
-    return hash(self.name)
+    return self.hash
 
   def __eq__(self, o):
-    return isinstance(o, Symbol) and self.name == o.name
+    return self is o or (isinstance(o, Symbol) and self.name == o.name)
 
   def __repr__(self):
     return "Symbol(%r)" % self.name
@@ -126,6 +133,270 @@ class Binary:
 
 # XXX: sym instead of Symbol?
 
+# Timestamps are milliseconds since the epoch, UTC. A Timestamp carries
+# them as they are on the wire and so avoids any conversion to or from
+# datetime.
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def timestamp_ms(dt):
+  offset = dt.utcoffset()
+  if offset is not None:
+    dt = dt.replace(tzinfo=None) - offset
+  d = dt - EPOCH
+  return (d.days*86400 + d.seconds)*1000 + d.microseconds//1000
+
+class Timestamp:
+
+  def __init__(self, ms):
+    self.ms = ms
+
+  def datetime(self):
+    return EPOCH + datetime.timedelta(milliseconds=self.ms)
+
+  def __hash__(self):
+    return hash(self.ms)
+
+  def __eq__(self, o):
+    return isinstance(o, Timestamp) and self.ms == o.ms
+
+  def __ne__(self, o):
+    return not self == o
+
+  def __repr__(self):
+    return "Timestamp(%r)" % self.ms
+
+# Shares a single Symbol between every decoded occurrence of the same
+# name. Entries live in two generations: when the young generation
+# fills up it replaces the old one, evicting whatever wasn't looked up
+# in the meantime, so the pool never holds more than 2*limit symbols.
+
+class SymbolPool:
+
+  def __init__(self, limit=1024):
+    self.limit = limit
+    self.young = {}
+    self.old = {}
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def intern(self, bytes):
+    sym = self.young.get(bytes)
+    if sym is not None:
+      self.hits += 1
+      return sym
+
+    sym = self.old.get(bytes)
+    if sym is None:
+      self.misses += 1
+      sym = Symbol(str(bytes.decode("ascii")))
+    else:
+      self.hits += 1
+
+    if len(self.young) >= self.limit:
+      self.evictions += len(self.old)
+      self.old = self.young
+      self.young = {}
+    self.young[bytes] = sym
+    return sym
+
+  def hit_rate(self):
+    lookups = self.hits + self.misses
+    if lookups:
+      return float(self.hits)/lookups
+    else:
+      return None
+
+  def __len__(self):
+    return len(self.young) + len(self.old)
+
+  def __repr__(self):
+    return "SymbolPool(size=%s, hits=%s, misses=%s, evictions=%s)" % \
+        (len(self), self.hits, self.misses, self.evictions)
+
+# Lazy values are read-only views of an encoded list, map, or array
+# that only decode an element when it is accessed. They hold on to
+# their encoded bytes so they can be re-encoded without decoding
+# anything.
+
+class Lazy(object):
+
+  def __init__(self, decoder, encoding, bytes, start, offset, end, count):
+    self.decoder = decoder
+    self.encoding = encoding
+    self.bytes = bytes
+    # the offset of the size, just past the constructor
+    self.start = start
+    self.end = end
+    self.count = count
+    # the offsets of the elements scanned so far
+    self.offsets = [offset]
+    self.cache = {}
+
+  def raw(self):
+    if isinstance(self.bytes, memoryview):
+      return self.bytes[self.start:self.end]
+    else:
+      return buffer(self.bytes, self.start, self.end - self.start)
+
+  def encoded(self):
+    return chr(self.encoding.code) + str(bytearray(self.raw()))
+
+  def decode_element(self, bytes, offset):
+    return self.decoder.decode_from(bytes, offset)[0]
+
+  def skip_element(self, bytes, offset):
+    return self.decoder.skip(bytes, offset)[-1]
+
+  def locate(self, idx):
+    offsets = self.offsets
+    while len(offsets) <= idx:
+      offsets.append(self.skip_element(self.bytes, offsets[-1]))
+    return offsets[idx]
+
+  def element(self, idx):
+    if idx not in self.cache:
+      self.cache[idx] = self.decode_element(self.bytes, self.locate(idx))
+    return self.cache[idx]
+
+  def decoded(self):
+    return [self.element(idx) for idx in range(self.count)]
+
+class LazyList(Lazy):
+
+  def __len__(self):
+    return self.count
+
+  def __getitem__(self, idx):
+    if isinstance(idx, slice):
+      return self.decoded()[idx]
+    if idx < 0:
+      idx += self.count
+    if idx < 0 or idx >= self.count:
+      raise IndexError(idx)
+    return self.element(idx)
+
+  def __iter__(self):
+    for idx in range(self.count):
+      yield self.element(idx)
+
+  def __eq__(self, o):
+    return isinstance(o, (list, tuple, LazyList)) and \
+        len(self) == len(o) and list(self) == list(o)
+
+  def __ne__(self, o):
+    return not self == o
+
+  def __repr__(self):
+    return repr(self.decoded())
+
+class LazyMap(Lazy):
+
+  def __init__(self, *args):
+    Lazy.__init__(self, *args)
+    # key -> index of the value
+    self.index = {}
+    self.scanned = 0
+
+  def scan(self):
+    key = self.element(2*self.scanned)
+    if key not in self.index:
+      self.index[key] = 2*self.scanned + 1
+    self.scanned += 1
+    return key
+
+  def pair(self, idx):
+    while self.scanned <= idx:
+      self.scan()
+    return self.element(2*idx), self.element(2*idx + 1)
+
+  def lookup(self, key):
+    if key in self.index:
+      return self.index[key]
+    while self.scanned < len(self):
+      if self.scan() == key:
+        return self.index[key]
+    return None
+
+  def __len__(self):
+    return self.count/2
+
+  def __getitem__(self, key):
+    idx = self.lookup(key)
+    if idx is None:
+      raise KeyError(key)
+    return self.element(idx)
+
+  def __contains__(self, key):
+    return self.lookup(key) is not None
+
+  def get(self, key, default=None):
+    idx = self.lookup(key)
+    if idx is None:
+      return default
+    else:
+      return self.element(idx)
+
+  def has_key(self, key):
+    return key in self
+
+  def iteritems(self):
+    for idx in range(len(self)):
+      yield self.pair(idx)
+
+  def iterkeys(self):
+    for k, v in self.iteritems():
+      yield k
+
+  def itervalues(self):
+    for k, v in self.iteritems():
+      yield v
+
+  def items(self):
+    return list(self.iteritems())
+
+  def keys(self):
+    return list(self.iterkeys())
+
+  def values(self):
+    return list(self.itervalues())
+
+  def __iter__(self):
+    return self.iterkeys()
+
+  def __eq__(self, o):
+    return isinstance(o, (dict, LazyMap)) and dict(self.items()) == dict(o.items())
+
+  def __ne__(self, o):
+    return not self == o
+
+  def __repr__(self):
+    return repr(dict(self.items()))
+
+class LazyElements(LazyList):
+
+  def __init__(self, type, code, decoder, *args):
+    LazyList.__init__(self, *args)
+    self.type = type
+    self.code = code
+    self.element_decoder = decoder
+
+  def decode_element(self, bytes, offset):
+    element, offset = self.element_decoder(bytes, offset)
+    return self.decoder.construct(self.type, element)
+
+  def skip_element(self, bytes, offset):
+    return self.decoder.skip_value(self.code, bytes, offset)
+
+class LazyArray(Array):
+
+  def __init__(self, values):
+    Array.__init__(self, values.type, values)
+
+  def encoded(self):
+    return self.values.encoded()
+
 class Encoding:
 
   def __init__(self, name, type, code, category, width):
@@ -163,10 +434,140 @@ WIDTH_CODES = {
   4: "I"
   }
 
+STRUCTS = {}
+
+def compiled(format):
+  try:
+    return STRUCTS[format]
+  except KeyError:
+    st = struct.Struct(format)
+    STRUCTS[format] = st
+    return st
+
+UINT_PAIR = compiled("!II")
+UINT_PAIR_PLACEHOLDER = "\x00"*UINT_PAIR.size
+UBYTE_PAIR = compiled("!BB")
+UBYTE = compiled("!B")
+LONG = compiled("!q")
+
+# struct formats for the encodings of fixed width numbers, arrays of
+# these are packed and unpacked in bulk rather than element by element
+BULK_FORMATS = {
+  "ubyte": "B",
+  "ushort": "H",
+  "uint": "I",
+  "uint_smalluint": "B",
+  "uint_uint0": "",
+  "ulong": "Q",
+  "ulong_smallulong": "B",
+  "ulong_ulong0": "",
+  "byte": "b",
+  "short": "h",
+  "int": "i",
+  "int_smallint": "b",
+  "long": "q",
+  "long_smalllong": "b",
+  "float_ieee_754": "f",
+  "double_ieee_754": "d"
+  }
+
+NUMBERS = set([int, long, float])
+type_of = type
+
+# struct format -> array typecode with the same width
+ARRAY_CODES = {}
+for format, codes in [("b", "b"), ("B", "B"), ("h", "h"), ("H", "H"),
+                      ("i", "il"), ("I", "IL"), ("q", "l"), ("Q", "L"),
+                      ("f", "f"), ("d", "d")]:
+  for code in codes:
+    if array.array(code).itemsize == struct.calcsize("!%s" % format):
+      ARRAY_CODES[format] = code
+      break
+
+def pack_array(format, values):
+  if not format:
+    return ""
+  code = ARRAY_CODES.get(format)
+  if code is not None and isinstance(values, array.array):
+    packed = array.array(code, values)
+    if sys.byteorder == "little":
+      packed.byteswap()
+    return buffer(packed)
+  else:
+    return struct.pack("!%s%s" % (len(values), format), *values)
+
+def unpack_array(format, bytes, offset, count, packed=False):
+  if not format:
+    return [0]*count
+  code = ARRAY_CODES.get(format)
+  if packed and code is not None:
+    values = array.array(code)
+    end = offset + values.itemsize*count
+    chunk = bytes[offset:end]
+    if isinstance(chunk, memoryview):
+      chunk = chunk.tobytes()
+    values.fromstring(chunk)
+    if sys.byteorder == "little":
+      values.byteswap()
+    return values
+  else:
+    return list(struct.unpack_from("!%s%s" % (count, format), bytes, offset))
+
+# A dict that counts its modifications, this lets the encoder and
+# decoder tell when anything they have derived from it is stale.
+
+class Versioned(dict):
+
+  def __init__(self, *args, **kwargs):
+    dict.__init__(self, *args, **kwargs)
+    self.version = 0
+
+  def __setitem__(self, key, value):
+    dict.__setitem__(self, key, value)
+    self.version += 1
+
+  def __delitem__(self, key):
+    dict.__delitem__(self, key)
+    self.version += 1
+
+  def clear(self):
+    dict.clear(self)
+    self.version += 1
+
+  def pop(self, *args):
+    self.version += 1
+    return dict.pop(self, *args)
+
+  def popitem(self):
+    self.version += 1
+    return dict.popitem(self)
+
+  def setdefault(self, key, default=None):
+    self.version += 1
+    return dict.setdefault(self, key, default)
+
+  def update(self, *args, **kwargs):
+    dict.update(self, *args, **kwargs)
+    self.version += 1
+
+# Values are encoded by appending to a single bytearray. Compound
+# values are written at full width with their size and count reserved
+# and filled in once their elements are written.
+#
+# When compact is set the encoder picks the narrowest encoding able to
+# hold each value (e.g. smalluint, str8, list8), otherwise it always
+# uses the widest encoding for the type. The sel_* methods make this
+# choice for scalar types with more than one encoding, returning the
+# encoding along with the value in the form expected by that
+# encoding's enc_* method. Compounds are narrowed in place after they
+# are written.
+
 class TypeEncoder:
 
-  def __init__(self, encodings=ENCODINGS):
+  def __init__(self, encodings=ENCODINGS, compact=True):
+    self.compact = compact
     self.encodings = {}
+    self.variants = {}
     self.encoders = {}
     for enc in encodings:
       if enc.type in self.encodings:
@@ -175,14 +576,31 @@ class TypeEncoder:
           self.encodings[enc.type] = enc
       else:
         self.encodings[enc.type] = enc
-      self.encoders[enc.type] = getattr(self, "enc_%s" % enc.type.name)
-    self.types = {
+      self.variants[enc.name] = enc
+      encoder = getattr(self, "enc_%s" % enc.name, None)
+      if encoder is None:
+        encoder = getattr(self, "enc_%s" % enc.type.name)
+      self.encoders[enc.name] = encoder
+    # compound encodings are written at full width and narrowed
+    # afterwards once their size is known
+    self.narrower = {}
+    for enc in encodings:
+      if enc.category in ("compound", "array") and enc.width == 1:
+        self.narrower[self.encodings[enc.type].name] = enc
+    self.bulk = set([self.variants[name].type for name in BULK_FORMATS])
+    self.selectors = {}
+    for type in self.encodings:
+      selector = getattr(self, "sel_%s" % type.name, None)
+      if selector is not None:
+        self.selectors[type] = selector
+    self.types = Versioned({
       bool: Primitive("boolean"),
       int: Primitive("long"),  # the boundary between int and long is
       long: Primitive("long"), # platform specific, so we treat them the
                                # same to avoid platform dependencies
       float: Primitive("double"), # python floats are actually doubles
       datetime.datetime: Primitive("timestamp"),
+      Timestamp: Primitive("timestamp"),
       dict: Primitive("map"),
       list: Primitive("list"),
       tuple: Primitive("list"),
@@ -194,146 +612,482 @@ class TypeEncoder:
       Symbol: Primitive("symbol"),
       Binary: Primitive("binary"),
       uuid.UUID: Primitive("uuid"),
+      LazyList: Primitive("list"),
+      LazyMap: Primitive("map"),
+      LazyArray: Primitive("array"),
       None.__class__: Primitive("null")
-      }
-    self.deconstructors = {
+      })
+    self.deconstructors = Versioned({
       Value: self.deconstruct_value,
-      }
+      })
+    # python class -> (deconstructor, type), one of which is None
+    self.resolved = {}
+    # python class -> encode callable
+    self.compiled = {}
+    # codec type -> encode callable
+    self.typed = {}
+    self.compiled_state = None
 
   def deconstruct_value(self, v):
     return v.type, v.value
 
-  def default_deconstructor(self, v):
-    return self.types[v.__class__], v
+  def resolve(self, cls):
+    try:
+      return self.resolved[cls]
+    except KeyError:
+      pass
+    # subclasses are encoded like the nearest class we know about
+    for base in inspect.getmro(cls):
+      if base in self.deconstructors:
+        result = (self.deconstructors[base], None)
+        break
+      elif base in self.types:
+        result = (None, self.types[base])
+        break
+    else:
+      raise TypeError("no encoding for %s" % cls.__name__)
+    self.resolved[cls] = result
+    return result
 
   def deconstruct(self, value):
-    deconstructor = self.deconstructors.get(value.__class__, self.default_deconstructor)
-    return deconstructor(value)
+    deconstructor, type = self.resolve(value.__class__)
+    if deconstructor is None:
+      return type, value
+    else:
+      return deconstructor(value)
+
+  # Everything compiled depends on the types, deconstructors, and
+  # compact setting, so it is all thrown away when any of them change.
+
+  def refresh(self):
+    state = (self.compact, id(self.types),
+             getattr(self.types, "version", None), id(self.deconstructors),
+             getattr(self.deconstructors, "version", None))
+    # we can't tell when a plain dict changes, so start over each time
+    if state != self.compiled_state or None in state:
+      self.resolved.clear()
+      self.compiled.clear()
+      self.typed.clear()
+      self.compiled_state = state
 
   def encode(self, value):
-    type, value = self.deconstruct(value)
-    encoder, encoded, value = self.encode_type(type, value)
-    return "%s%s" % (encoded, encoder(value))
+    out = bytearray()
+    self.encode_into(out, value)
+    return str(out)
+
+  def encode_into(self, out, value):
+    self.refresh()
+    self.write(out, value)
+
+  def write(self, out, value):
+    try:
+      encoder = self.compiled[value.__class__]
+    except KeyError:
+      encoder = self.compile(value.__class__)
+    encoder(out, value)
+
+  def compile(self, cls):
+    deconstructor, type = self.resolve(cls)
+    if deconstructor is None:
+      encoder = self.type_encoder(type)
+    else:
+      def encoder(out, value):
+        type, value = deconstructor(value)
+        self.type_encoder(type)(out, value)
+    self.compiled[cls] = encoder
+    return encoder
+
+  def type_encoder(self, type):
+    try:
+      return self.typed[type]
+    except KeyError:
+      encoder = type.compile(self)
+      self.typed[type] = encoder
+      return encoder
+
+  def encode_type(self, out, type, value):
+    self.type_encoder(type)(out, value)
+
+  def encode_described(self, out, type, value):
+    self.type_encoder(type)(out, value)
+
+  def encode_primitive(self, out, type, value):
+    self.type_encoder(type)(out, value)
+
+  def compile_described(self, type):
+    if type.source is None:
+      def encoder(out, value):
+        source, value = self.deconstruct(value)
+        out.extend(prefix)
+        self.type_encoder(source)(out, value)
+    else:
+      source = self.type_encoder(type.source)
+      def encoder(out, value):
+        out.extend(prefix)
+        source(out, value)
+    # the descriptor is the same every time
+    prefix = bytearray([0])
+    self.write(prefix, type.descriptor)
+    prefix = str(prefix)
+    return encoder
+
+  def compile_primitive(self, type):
+    if type.name is None:
+      return self.write
+
+    selector = self.selectors.get(type)
+    if selector is not None:
+      encoders = self.encoders
+      def encoder(out, value):
+        enc, value = selector(value)
+        out.append(enc.code)
+        encoders[enc.name](out, value)
+      return encoder
+
+    enc = self.encodings[type]
+    code = enc.code
+    writer = self.encoders[enc.name]
+    if enc.category not in ("compound", "array"):
+      def encoder(out, value):
+        out.append(code)
+        writer(out, value)
+      return encoder
+
+    if self.compact:
+      narrower = self.narrower.get(enc.name)
+    else:
+      narrower = None
+    def encoder(out, value):
+      if isinstance(value, Lazy) and value.encoding.type == type:
+        self.encode_lazy(out, value)
+      elif isinstance(value, LazyArray) and type.name == "array":
+        self.encode_lazy(out, value.values)
+      else:
+        start = len(out)
+        out.append(code)
+        writer(out, value)
+        if narrower is not None:
+          self.narrow_compound(out, start, narrower)
+    return encoder
+
+  def encode_lazy(self, out, value):
+    out.append(value.encoding.code)
+    out.extend(value.raw())
+
+  def narrow_compound(self, out, start, enc):
+    size, count = UINT_PAIR.unpack_from(out, start + 1)
+    if count == 0 and enc.type.name == "list":
+      out[start] = self.variants["list_list0"].code
+      del out[start + 1:start + 9]
+    # the narrow size field covers one byte of count rather than four
+    elif size < 259 and count < 256:
+      out[start] = enc.code
+      out[start + 1:start + 9] = UBYTE_PAIR.pack(size - 3, count)
+
+  def select(self, type, value):
+    selector = self.selectors.get(type)
+    if selector is None:
+      return self.encodings[type], value
+    else:
+      return selector(value)
+
+  def narrow(self, name):
+    enc = self.variants[name]
+    if self.compact:
+      return enc
+    else:
+      return self.encodings[enc.type]
 
-  def encode_type(self, type, value):
-    return type.encode(self, value)
+  def sel_boolean(self, b):
+    if b:
+      return self.narrow("boolean_true"), b
+    else:
+      return self.narrow("boolean_false"), b
 
-  def encode_described(self, type, value):
-    if type.source is None:
-      source, value = self.deconstruct(value)
+  def sel_uint(self, i):
+    if i == 0:
+      return self.narrow("uint_uint0"), i
+    elif i < 256:
+      return self.narrow("uint_smalluint"), i
     else:
-      source = type.source
-    encoder, encoded, value = self.encode_type(source, value)
-    return encoder, "\x00%s%s" % (self.encode(type.descriptor), encoded), value
+      return self.encodings[Primitive("uint")], i
 
-  def encode_primitive(self, type, value):
-    if type.name is None:
-      type, value = self.deconstruct(value)
-      return self.encode_type(type, value)
+  def sel_ulong(self, l):
+    if l == 0:
+      return self.narrow("ulong_ulong0"), l
+    elif l < 256:
+      return self.narrow("ulong_smallulong"), l
+    else:
+      return self.encodings[Primitive("ulong")], l
+
+  def sel_int(self, i):
+    if -128 <= i < 128:
+      return self.narrow("int_smallint"), i
+    else:
+      return self.encodings[Primitive("int")], i
+
+  def sel_long(self, l):
+    if -128 <= l < 128:
+      return self.narrow("long_smalllong"), l
     else:
+      return self.encodings[Primitive("long")], l
+
+  def sel_variable(self, short, long, bytes):
+    if len(bytes) < 256:
+      return self.narrow(short), bytes
+    else:
+      return self.variants[long], bytes
+
+  def sel_binary(self, b):
+    if isinstance(b, Binary):
+      b = b.bytes
+    return self.sel_variable("binary_vbin8", "binary_vbin32", b)
+
+  def sel_string(self, s):
+    return self.sel_variable("string_str8_utf8", "string_str32_utf8",
+                             s.encode("utf8"))
+
+  def sel_symbol(self, s):
+    if isinstance(s, basestring):
+      bytes = s.encode("ascii")
+    else:
+      bytes = s.name.encode("ascii")
+    return self.sel_variable("symbol_sym8", "symbol_sym32", bytes)
+
+  def encode_elements(self, out, type, values):
+    if isinstance(type, Described):
+      out.append(0)
+      self.write(out, type.descriptor)
+      return self.encode_elements(out, type.source, values)
+
+    selector = self.selectors.get(type)
+    if selector is None:
       enc = self.encodings[type]
-      encoder = self.encoders[enc.type]
-      return encoder, struct.pack("!B", enc.code), value
+    else:
+      selected = [selector(v) for v in values]
+      enc = self.unify(type, [e for e, v in selected])
+      values = [v for e, v in selected]
+    out.append(enc.code)
+    return self.encoders[enc.name], values
+
+  def unify(self, type, encs):
+    # every element shares a single constructor, so pick the
+    # narrowest encoding able to hold all of them
+    encs = set(encs)
+    if not encs:
+      return self.encodings[type]
+    elif len(encs) == 1:
+      return encs.pop()
+    else:
+      widest = max([e.width for e in encs])
+      encs = [e for e in encs if e.width == widest]
+      if len(encs) == 1:
+        return encs[0]
+      else:
+        return self.encodings[type]
+
+  def encode_bulk(self, out, type, values):
+    if type not in self.bulk:
+      return False
+    if not isinstance(values, array.array) and \
+          not set(map(type_of, values)) <= NUMBERS:
+      return False
+    selector = self.selectors.get(type)
+    if selector is None or not len(values):
+      enc = self.encodings[type]
+    else:
+      # the encoding able to hold both extremes can hold every value
+      enc = self.unify(type, [selector(min(values))[0],
+                              selector(max(values))[0]])
+    out.append(enc.code)
+    out.extend(pack_array(BULK_FORMATS[enc.name], values))
+    return True
 
-  def enc_null(self, n):
-    return ""
+  def enc_null(self, out, n):
+    pass
 
-  def enc_boolean(self, b):
+  def enc_boolean(self, out, b):
     if b:
-      return "\x01"
+      out.append(1)
     else:
-      return "\x00"
+      out.append(0)
 
-  def enc_ubyte(self, b):
-    return struct.pack("!B", b)
+  def enc_boolean_true(self, out, b):
+    pass
 
-  def enc_ushort(self, s):
-    return struct.pack("!H", s)
+  def enc_boolean_false(self, out, b):
+    pass
 
-  def enc_uint(self, i):
-    return struct.pack("!I", i)
+  def enc_fixed(self, format, out, value):
+    out.extend(compiled(format).pack(value))
 
-  def enc_ulong(self, l):
-    return struct.pack("!Q", l)
+  def enc_ubyte(self, out, b):
+    self.enc_fixed("!B", out, b)
 
-  def enc_byte(self, b):
-    return struct.pack("!b", b)
+  def enc_ushort(self, out, s):
+    self.enc_fixed("!H", out, s)
 
-  def enc_short(self, s):
-    return struct.pack("!h", s)
+  def enc_uint(self, out, i):
+    self.enc_fixed("!I", out, i)
 
-  def enc_int(self, i):
-    return struct.pack("!i", i)
+  def enc_uint_uint0(self, out, i):
+    pass
 
-  def enc_long(self, l):
-    return struct.pack("!q", l)
+  def enc_uint_smalluint(self, out, i):
+    self.enc_fixed("!B", out, i)
 
-  def enc_float(self, f):
-    return struct.pack("!f", f)
+  def enc_ulong(self, out, l):
+    self.enc_fixed("!Q", out, l)
 
-  def enc_double(self, d):
-    return struct.pack("!d", d)
+  def enc_ulong_ulong0(self, out, l):
+    pass
 
-  def enc_decimal32(self, d):
-    xxx
+  def enc_ulong_smallulong(self, out, l):
+    self.enc_fixed("!B", out, l)
 
-  def enc_decimal64(self, d):
-    xxx
+  def enc_byte(self, out, b):
+    self.enc_fixed("!b", out, b)
 
-  def enc_decimal128(self, d):
-    xxx
+  def enc_short(self, out, s):
+    self.enc_fixed("!h", out, s)
 
-  def enc_char(self, c):
-    return struct.pack("!I", ord(c))
+  def enc_int(self, out, i):
+    self.enc_fixed("!i", out, i)
 
-  def enc_timestamp(self, t):
-    return struct.pack("!q", 1000*int(time.mktime(t.timetuple())))
+  def enc_int_smallint(self, out, i):
+    self.enc_fixed("!b", out, i)
 
-  def enc_uuid(self, u):
-    return struct.pack("!16s", u.bytes)
+  def enc_long(self, out, l):
+    self.enc_fixed("!q", out, l)
 
-  def enc_binary(self, b):
-    if isinstance(b, Binary):
-      b = b.bytes
-    return struct.pack("!I", len(b)) + b
+  def enc_long_smalllong(self, out, l):
+    self.enc_fixed("!b", out, l)
 
-  def enc_string(self, s):
-    bytes = s.encode("utf8")
-    return self.enc_binary(bytes)
+  def enc_float(self, out, f):
+    self.enc_fixed("!f", out, f)
 
-  def enc_symbol(self, s):
-    if isinstance(s, basestring):
-      bytes = s.encode("ascii")
-    else:
-      bytes = s.name.encode("ascii")
-    return self.enc_binary(bytes)
-
-  def enc_list(self, l):
-    encoded = "".join([self.encode(x) for x in l])
-    return self.enc_binary("%s%s" % (struct.pack("!I", len(l)), encoded))
-
-  def enc_array(self, a):
-    type = a.type
-    encoder, etype, _ = self.encode_type(type, None)
-    count = struct.pack("!I", len(a.values))
-    # XXX: should check that deconstructed value matches array type & descriptor
-    encoded = "".join([encoder(self.deconstruct(v)[-1]) for v in a.values])
-
-    return self.enc_binary("%s%s%s" % (count, etype, encoded))
- 
-  def enc_map(self, m):
-    pairs = []
-    for pair in m.items():
-      pairs.extend(pair)
-    return self.enc_list(pairs)
+  def enc_double(self, out, d):
+    self.enc_fixed("!d", out, d)
+
+  def enc_decimal32(self, out, d):
+    xxx
+
+  def enc_decimal64(self, out, d):
+    xxx
+
+  def enc_decimal128(self, out, d):
+    xxx
+
+  def enc_char(self, out, c):
+    self.enc_fixed("!I", out, ord(c))
+
+  def enc_timestamp(self, out, t):
+    if isinstance(t, Timestamp):
+      t = t.ms
+    elif isinstance(t, datetime.datetime):
+      t = timestamp_ms(t)
+    out.extend(LONG.pack(t))
+
+  def enc_uuid(self, out, u):
+    out.extend(u.bytes)
+
+  def enc_variable8(self, out, bytes):
+    out.append(len(bytes))
+    out.extend(bytes)
+
+  def enc_variable32(self, out, bytes):
+    self.enc_fixed("!I", out, len(bytes))
+    out.extend(bytes)
+
+  def enc_binary_vbin8(self, out, b):
+    self.enc_variable8(out, b)
+
+  def enc_binary_vbin32(self, out, b):
+    self.enc_variable32(out, b)
+
+  def enc_string_str8_utf8(self, out, bytes):
+    self.enc_variable8(out, bytes)
+
+  def enc_string_str32_utf8(self, out, bytes):
+    self.enc_variable32(out, bytes)
+
+  def enc_symbol_sym8(self, out, bytes):
+    self.enc_variable8(out, bytes)
+
+  def enc_symbol_sym32(self, out, bytes):
+    self.enc_variable32(out, bytes)
+
+  def reserve(self, out):
+    start = len(out)
+    out.extend(UINT_PAIR_PLACEHOLDER)
+    return start
+
+  def fill(self, out, start, count):
+    # the size covers everything after the size field itself
+    UINT_PAIR.pack_into(out, start, len(out) - start - 4, count)
+
+  def enc_list(self, out, l):
+    start = self.reserve(out)
+    for x in l:
+      self.write(out, x)
+    self.fill(out, start, len(l))
+
+  def enc_map(self, out, m):
+    start = self.reserve(out)
+    for k, v in m.iteritems():
+      self.write(out, k)
+      self.write(out, v)
+    self.fill(out, start, 2*len(m))
+
+  def enc_array(self, out, a):
+    start = self.reserve(out)
+    if not self.encode_bulk(out, a.type, a.values):
+      # XXX: should check that deconstructed value matches array type & descriptor
+      values = [self.deconstruct(v)[-1] for v in a.values]
+      encoder, values = self.encode_elements(out, a.type, values)
+      for v in values:
+        encoder(out, v)
+    self.fill(out, start, len(a.values))
+
+# The dec_* methods take the buffer being decoded and the offset to
+# start from, and return the value along with the offset just past
+# it. This way decoding a compound never copies the remainder of the
+# buffer. The buffer may be a str or a memoryview.
+
+# When lazy is set lists, maps, and arrays decode to Lazy views rather
+# than being decoded eagerly. When packed_arrays is set the values of
+# numeric arrays decode to an array.array. When raw_timestamps is set
+# timestamps decode to a Timestamp rather than a (naive, UTC) datetime.
 
 class TypeDecoder:
 
-  def __init__(self, encodings=ENCODINGS):
+  def __init__(self, encodings=ENCODINGS, lazy=False, packed_arrays=False,
+               raw_timestamps=False):
+    self.lazy = lazy
+    self.packed_arrays = packed_arrays
+    self.raw_timestamps = raw_timestamps
     self.encodings = {}
+    self.variants = {}
+    # code -> (fixed width, size format), used to skip over values
+    self.extents = {}
+    # code -> struct format for arrays decoded in bulk
+    self.bulk = {}
     for enc in encodings:
+      if enc.name in BULK_FORMATS:
+        self.bulk[enc.code] = BULK_FORMATS[enc.name]
       self.encodings[enc.code] = (enc, getattr(self, "dec_%s" % enc.name))
-    self.constructors = {}
+      self.variants[enc.name] = enc
+      if enc.category == "fixed":
+        self.extents[enc.code] = (enc.width, None)
+      else:
+        self.extents[enc.code] = (0, compiled("!%s" % WIDTH_CODES[enc.width]))
+    self.constructors = Versioned()
+    self.symbols = SymbolPool()
+    # raw descriptor and source code -> (type, decoder, constructor)
+    self.descriptors = {}
+    self.descriptors_limit = 256
+    self.descriptors_owner = None
+    self.descriptors_version = None
 
   def construct(self, type, value):
     return type.construct(self, value)
@@ -347,161 +1101,260 @@ class TypeDecoder:
     return cons(type, value)
 
   def decode(self, bytes):
-    type, decoder, bytes = self.decode_type(bytes)
-    value, bytes = decoder(bytes)
-    return self.construct(type, value), bytes
+    value, offset = self.decode_from(bytes)
+    return value, bytes[offset:]
 
-  def decode_type(self, bytes):
-    code, bytes = self.unpack("!B", bytes)
+  def decode_from(self, bytes, offset=0):
+    code = UBYTE.unpack_from(bytes, offset)[0]
     if code == 0:
-      descriptor, bytes = self.decode(bytes)
-      source, decoder, bytes = self.decode_type(bytes)
-      return Described(descriptor, source), decoder, bytes
+      type, decoder, cons, offset = self.decode_descriptor(bytes, offset + 1)
+      value, offset = decoder(bytes, offset)
+      return cons(type, self.construct(type.source, value)), offset
     else:
       encoding, decoder = self.encodings[code]
-      return encoding.type, decoder, bytes
+      value, offset = decoder(bytes, offset + 1)
+      return self.construct(encoding.type, value), offset
 
-  def unpack(self, format, bytes, constructor=identity):
-    n = struct.calcsize(format)
-    return constructor(*struct.unpack(format, bytes[:n])), bytes[n:]
+  def decode_type(self, bytes, offset=0):
+    code, offset = self.unpack("!B", bytes, offset)
+    if code == 0:
+      type, decoder, cons, offset = self.decode_descriptor(bytes, offset)
+      return type, decoder, offset
+    else:
+      encoding, decoder = self.encodings[code]
+      return encoding.type, decoder, offset
+
+  def descriptor_cache(self):
+    constructors = self.constructors
+    version = getattr(constructors, "version", None)
+    # we can't tell when a plain dict changes, so don't cache anything
+    if version is None:
+      return None
+    if constructors is not self.descriptors_owner or \
+          version != self.descriptors_version:
+      self.descriptors.clear()
+      self.descriptors_owner = constructors
+      self.descriptors_version = version
+    return self.descriptors
+
+  def decode_descriptor(self, bytes, offset):
+    cache = self.descriptor_cache()
+    if cache is not None:
+      # the key includes the constructor of the source
+      end = self.skip(bytes, offset)[-1] + 1
+      key = self.slice(bytes, offset, end)
+      entry = cache.get(key)
+      if entry is not None:
+        return entry + (end,)
+
+    descriptor, offset = self.decode_from(bytes, offset)
+    source, decoder, offset = self.decode_type(bytes, offset)
+    type = Described(descriptor, source)
+    entry = (type, decoder, self.constructors.get(descriptor, Value))
+    # a described source isn't covered by the key
+    if cache is not None and offset == end:
+      if len(cache) >= self.descriptors_limit:
+        cache.clear()
+      cache[key] = entry
+    return entry + (offset,)
+
+  # Skip scans over the value at offset without decoding it, returning
+  # the code of its encoding, its descriptor if it is described, and
+  # the offset just past it.
+
+  def skip(self, bytes, offset=0):
+    code = UBYTE.unpack_from(bytes, offset)[0]
+    if code == 0:
+      descriptor, offset = self.decode_from(bytes, offset + 1)
+      code, _, end = self.skip(bytes, offset)
+      return code, descriptor, end
+    else:
+      return code, None, self.skip_value(code, bytes, offset + 1)
 
-  def dec_null(self, bytes):
-    return None, bytes
+  def skip_value(self, code, bytes, offset):
+    width, size = self.extents[code]
+    if size is None:
+      return offset + width
+    else:
+      return offset + size.size + size.unpack_from(bytes, offset)[0]
+
+  def unpack(self, format, bytes, offset, constructor=identity):
+    st = compiled(format)
+    return constructor(*st.unpack_from(bytes, offset)), offset + st.size
+
+  def slice(self, bytes, start, end):
+    result = bytes[start:end]
+    if isinstance(result, memoryview):
+      result = result.tobytes()
+    elif isinstance(result, bytearray):
+      result = str(result)
+    return result
 
-  def dec_boolean(self, bytes):
-    v, bytes = self.unpack("!B", bytes)
-    return v != 0, bytes
+  def dec_null(self, bytes, offset):
+    return None, offset
 
-  def dec_boolean_true(self, bytes):
-    return True, bytes
+  def dec_boolean(self, bytes, offset):
+    v, offset = self.unpack("!B", bytes, offset)
+    return v != 0, offset
 
-  def dec_boolean_false(self, bytes):
-    return False, bytes
+  def dec_boolean_true(self, bytes, offset):
+    return True, offset
 
-  def dec_ubyte(self, bytes):
-    return self.unpack("!B", bytes)
+  def dec_boolean_false(self, bytes, offset):
+    return False, offset
 
-  def dec_ushort(self, bytes):
-    return self.unpack("!H", bytes)
+  def dec_ubyte(self, bytes, offset):
+    return self.unpack("!B", bytes, offset)
 
-  def dec_uint(self, bytes):
-    return self.unpack("!I", bytes)
+  def dec_ushort(self, bytes, offset):
+    return self.unpack("!H", bytes, offset)
 
-  def dec_uint_uint0(self, bytes):
-    return 0, bytes
+  def dec_uint(self, bytes, offset):
+    return self.unpack("!I", bytes, offset)
 
-  def dec_uint_smalluint(self, bytes):
-    return self.unpack("!B", bytes)
+  def dec_uint_uint0(self, bytes, offset):
+    return 0, offset
 
-  def dec_ulong(self, bytes):
-    return self.unpack("!Q", bytes)
+  def dec_uint_smalluint(self, bytes, offset):
+    return self.unpack("!B", bytes, offset)
 
-  def dec_ulong_ulong0(self, bytes):
-    return 0, bytes
+  def dec_ulong(self, bytes, offset):
+    return self.unpack("!Q", bytes, offset)
 
-  def dec_ulong_smallulong(self, bytes):
-    return self.unpack("!B", bytes)
+  def dec_ulong_ulong0(self, bytes, offset):
+    return 0, offset
 
-  def dec_byte(self, bytes):
-    return self.unpack("!b", bytes)
+  def dec_ulong_smallulong(self, bytes, offset):
+    return self.unpack("!B", bytes, offset)
 
-  def dec_short(self, bytes):
-    return self.unpack("!h", bytes)
+  def dec_byte(self, bytes, offset):
+    return self.unpack("!b", bytes, offset)
 
-  def dec_int(self, bytes):
-    return self.unpack("!i", bytes)
+  def dec_short(self, bytes, offset):
+    return self.unpack("!h", bytes, offset)
 
-  def dec_int_smallint(self, bytes):
-    return self.unpack("!b", bytes)
+  def dec_int(self, bytes, offset):
+    return self.unpack("!i", bytes, offset)
 
-  def dec_long(self, bytes):
-    return self.unpack("!q", bytes)
+  def dec_int_smallint(self, bytes, offset):
+    return self.unpack("!b", bytes, offset)
 
-  def dec_long_smalllong(self, bytes):
-    return self.unpack("!b", bytes)
+  def dec_long(self, bytes, offset):
+    return self.unpack("!q", bytes, offset)
 
-  def dec_float_ieee_754(self, bytes):
-    return self.unpack("!f", bytes)
+  def dec_long_smalllong(self, bytes, offset):
+    return self.unpack("!b", bytes, offset)
 
-  def dec_double_ieee_754(self, bytes):
-    return self.unpack("!d", bytes)
+  def dec_float_ieee_754(self, bytes, offset):
+    return self.unpack("!f", bytes, offset)
 
-  def dec_decimal32_ieee_754(self, bytes):
+  def dec_double_ieee_754(self, bytes, offset):
+    return self.unpack("!d", bytes, offset)
+
+  def dec_decimal32_ieee_754(self, bytes, offset):
     xxx
 
-  def dec_decimal64_ieee_754(self, bytes):
+  def dec_decimal64_ieee_754(self, bytes, offset):
     xxx
 
-  def dec_decimal128_ieee_754(self, bytes):
+  def dec_decimal128_ieee_754(self, bytes, offset):
     xxx
 
-  def dec_char_utf32(self, bytes):
-    return self.unpack("!I", bytes, unichr)
+  def dec_char_utf32(self, bytes, offset):
+    return self.unpack("!I", bytes, offset, unichr)
 
-  def dec_timestamp_ms64(self, bytes):
-    ms, bytes = self.dec_long(bytes)
-    return datetime.datetime.fromtimestamp(ms/1000.0), bytes
+  def dec_timestamp_ms64(self, bytes, offset):
+    ms = LONG.unpack_from(bytes, offset)[0]
+    if self.raw_timestamps:
+      return Timestamp(ms), offset + 8
+    else:
+      return EPOCH + datetime.timedelta(milliseconds=ms), offset + 8
 
-  def dec_uuid(self, bytes):
-    return uuid.UUID(bytes=bytes[:16]), bytes[16:]
+  def dec_uuid(self, bytes, offset):
+    end = offset + 16
+    return uuid.UUID(bytes=self.slice(bytes, offset, end)), end
 
-  def dec_variable(self, format, bytes, constructor=identity):
-    size, bytes = self.unpack(format, bytes)
-    return constructor(bytes[:size]), bytes[size:]
+  def dec_variable(self, format, bytes, offset, constructor=identity):
+    size, offset = self.unpack(format, bytes, offset)
+    end = offset + size
+    return constructor(self.slice(bytes, offset, end)), end
 
-  def dec_binary_vbin8(self, bytes):
-    return self.dec_variable("!B", bytes)
+  def dec_binary_vbin8(self, bytes, offset):
+    return self.dec_variable("!B", bytes, offset)
 
-  def dec_binary_vbin32(self, bytes):
-    return self.dec_variable("!I", bytes)
+  def dec_binary_vbin32(self, bytes, offset):
+    return self.dec_variable("!I", bytes, offset)
 
-  def dec_string_str8_utf8(self, bytes):
-    return self.dec_variable("!B", bytes, lambda x: x.decode("utf8"))
+  def dec_string_str8_utf8(self, bytes, offset):
+    return self.dec_variable("!B", bytes, offset, lambda x: x.decode("utf8"))
 
-  def dec_string_str32_utf8(self, bytes):
-    return self.dec_variable("!I", bytes, lambda x: x.decode("utf8"))
+  def dec_string_str32_utf8(self, bytes, offset):
+    return self.dec_variable("!I", bytes, offset, lambda x: x.decode("utf8"))
 
-  def dec_symbol_sym8(self, bytes):
-    return self.dec_variable("!B", bytes, lambda x: Symbol(str(x.decode("ascii"))))
+  def dec_symbol_sym8(self, bytes, offset):
+    return self.dec_variable("!B", bytes, offset, self.symbols.intern)
 
-  def dec_symbol_sym32(self, bytes):
-    return self.dec_variable("!I", bytes, lambda x: Symbol(str(x.decode("ascii"))))
+  def dec_symbol_sym32(self, bytes, offset):
+    return self.dec_variable("!I", bytes, offset, self.symbols.intern)
 
-  def dec_compound(self, format, bytes, constructor=identity):
-    (size, count), bytes = self.unpack(format, bytes, lambda s, c: (s, c))
+  def dec_compound(self, name, format, bytes, offset, constructor=identity,
+                   view=LazyList):
+    start = offset
+    (size, count), offset = self.unpack(format, bytes, offset, lambda s, c: (s, c))
+    if self.lazy:
+      # the size covers everything after the size field itself
+      end = start + compiled(format).size/2 + size
+      return view(self, self.variants[name], bytes, start, offset, end, count), end
     result = []
     while count > 0:
-      value, bytes = self.decode(bytes)
+      value, offset = self.decode_from(bytes, offset)
       result.append(value)
       count -= 1
-    return constructor(result), bytes
-
-  def dec_list_list0(self, bytes):
-    return [], bytes
-
-  def dec_list_list8(self, bytes):
-    return self.dec_compound("!BB", bytes)
-
-  def dec_list_list32(self, bytes):
-    return self.dec_compound("!II", bytes)
-
-  def dec_array(self, format, bytes, constructor=identity):
-    (size, count), bytes = self.unpack(format, bytes, lambda s, c: (s, c))
-    type, decoder, bytes = self.decode_type(bytes)
+    return constructor(result), offset
+
+  def dec_list_list0(self, bytes, offset):
+    return [], offset
+
+  def dec_list_list8(self, bytes, offset):
+    return self.dec_compound("list_list8", "!BB", bytes, offset)
+
+  def dec_list_list32(self, bytes, offset):
+    return self.dec_compound("list_list32", "!II", bytes, offset)
+
+  def dec_array(self, name, format, bytes, offset):
+    start = offset
+    (size, count), offset = self.unpack(format, bytes, offset, lambda s, c: (s, c))
+    type, decoder, offset = self.decode_type(bytes, offset)
+
+    if self.lazy:
+      end = start + compiled(format).size/2 + size
+      # the element constructor always ends with the primitive code
+      code = UBYTE.unpack_from(bytes, offset - 1)[0]
+      values = LazyElements(type, code, decoder, self, self.variants[name],
+                            bytes, start, offset, end, count)
+      return LazyArray(values), end
+
+    if isinstance(type, Primitive):
+      code = UBYTE.unpack_from(bytes, offset - 1)[0]
+      if code in self.bulk:
+        end = start + compiled(format).size/2 + size
+        values = unpack_array(self.bulk[code], bytes, offset, count,
+                              self.packed_arrays)
+        return Array(type, values), end
 
     values = []
     while count > 0:
-      element, bytes = decoder(bytes)
+      element, offset = decoder(bytes, offset)
       values.append(self.construct(type, element))
       count -= 1
 
-    return Array(type, values), bytes
+    return Array(type, values), offset
 
-  def dec_array_array8(self, bytes):
-    return self.dec_array("!BB", bytes)
+  def dec_array_array8(self, bytes, offset):
+    return self.dec_array("array_array8", "!BB", bytes, offset)
 
-  def dec_array_array32(self, bytes):
-    return self.dec_array("!II", bytes)
+  def dec_array_array32(self, bytes, offset):
+    return self.dec_array("array_array32", "!II", bytes, offset)
 
   def dec_map(self, elements):
     result = {}
@@ -509,8 +1362,127 @@ class TypeDecoder:
       result[k] = v
     return result
 
-  def dec_map_map8(self, bytes):
-    return self.dec_compound("!BB", bytes, self.dec_map)
+  def dec_map_map8(self, bytes, offset):
+    return self.dec_compound("map_map8", "!BB", bytes, offset, self.dec_map,
+                             LazyMap)
+
+  def dec_map_map32(self, bytes, offset):
+    return self.dec_compound("map_map32", "!II", bytes, offset, self.dec_map,
+                             LazyMap)
 
-  def dec_map_map32(self, bytes):
-    return self.dec_compound("!II", bytes, self.dec_map)
+# A StreamDecoder decodes values as their bytes arrive rather than
+# once the whole of them is buffered. Compounds (lists, maps, and
+# arrays, described or not) nested no deeper than depth are opened as
+# soon as their header is available, and their elements are then
+# decoded one at a time. Bytes are only held until the value or
+# element they belong to is complete.
+#
+# Read returns the events decoded so far: (BEGIN, type) when a
+# compound is opened, (VALUE, value) for each complete value, and
+# (END, type) when a compound is closed. The elements of a map
+# alternate between keys and values.
+
+BEGIN = Constant("BEGIN")
+VALUE = Constant("VALUE")
+END = Constant("END")
+
+class StreamDecoder:
+
+  def __init__(self, decoder=None, depth=1):
+    if decoder is None:
+      decoder = TypeDecoder()
+    self.decoder = decoder
+    self.depth = depth
+    self.buffer = bytearray()
+    # open compounds: [type, elements remaining, array element or None]
+    self.stack = []
+
+  def write(self, bytes):
+    self.buffer.extend(bytes)
+
+  def pending(self):
+    return len(self.buffer)
+
+  def closed(self):
+    return not self.stack and not self.buffer
+
+  def read(self):
+    events = []
+    offset = 0
+    while True:
+      if self.stack and self.stack[-1][1] == 0:
+        type = self.stack.pop()[0]
+        events.append((END, type))
+        if self.stack:
+          self.stack[-1][1] -= 1
+        continue
+      if not self.stack and offset == len(self.buffer):
+        break
+      if len(self.stack) < self.depth and \
+            (not self.stack or self.stack[-1][2] is None):
+        header = self.open(offset)
+        if header is None:
+          break
+        if header is not VALUE:
+          type, count, element, offset = header
+          self.stack.append([type, count, element])
+          events.append((BEGIN, type))
+          continue
+      result = self.element(offset)
+      if result is None:
+        break
+      value, offset = result
+      events.append((VALUE, value))
+      if self.stack:
+        self.stack[-1][1] -= 1
+    del self.buffer[:offset]
+    return events
+
+  # Returns the type, element count, array element, and end of the
+  # header of the compound at offset, VALUE if the value at offset
+  # isn't a compound, or None if more bytes are needed to tell.
+
+  def open(self, offset):
+    decoder = self.decoder
+    try:
+      type, _, offset = decoder.decode_type(self.buffer, offset)
+      code = self.buffer[offset - 1]
+      encoding = decoder.encodings[code][0]
+      if encoding.category not in ("compound", "array"):
+        return VALUE
+      format = compiled("!%s" % (WIDTH_CODES[encoding.width]*2))
+      count = format.unpack_from(self.buffer, offset)[1]
+      offset += format.size
+      if encoding.category == "array":
+        etype, edecoder, offset = decoder.decode_type(self.buffer, offset)
+        element = (etype, edecoder, self.buffer[offset - 1])
+      else:
+        element = None
+      return type, count, element, offset
+    except (struct.error, IndexError):
+      return None
+
+  # Returns the value at offset and the offset past it, or None if it
+  # isn't complete yet.
+
+  def element(self, offset):
+    decoder = self.decoder
+    element = self.stack and self.stack[-1][2]
+    try:
+      if element:
+        etype, edecoder, ecode = element
+        end = decoder.skip_value(ecode, self.buffer, offset)
+      else:
+        end = decoder.skip(self.buffer, offset)[-1]
+    except (struct.error, IndexError):
+      return None
+    if end > len(self.buffer):
+      return None
+    # decode from a copy so nothing refers to the buffer once it is
+    # compacted
+    bytes = str(self.buffer[offset:end])
+    if element:
+      value = decoder.construct(etype, edecoder(bytes, 0)[0])
+    else:
+      value = decoder.decode_from(bytes)[0]
+    return value, end
@@ -20,6 +20,7 @@
 from dispatcher import Dispatcher
 from framing import AMQP_FRAME
 from protocol import *
+from util import Allocator, Exhausted
 from uuid import uuid4
 
 
@@ -46,8 +47,22 @@ class Connection(Dispatcher):
     self.incoming = {}
     # outgoing channel -> session
     self.outgoing = {}
+    # sessions with frames to read or links to tick, and how many
+    # endpoints tick visited or had no reason to
+    self.dirty = set()
+    self.ticks = 0
+    self.skipped = 0
+    # sessions with links the peer has done something to, or that it
+    # has begun or ended
+    self.active = set()
 
     self.max_frame_size = 4294967295
+    # the peer's idle-time-out, in seconds
+    self.idle_timeout = None
+    # the highest incoming channel we accept
+    self.channel_max = 65535
+    # outgoing channels, limited by our channel_max and the peer's
+    self.channels = Allocator(self.channel_max)
 
   def post_frame(self, channel, body):
     # XXX: if we hit an error then we pretend we've sent a close
@@ -71,15 +86,37 @@ class Connection(Dispatcher):
     ssn = self.incoming[channel]
     ssn.write(body)
 
+  def mark(self, ssn):
+    self.dirty.add(ssn)
+
+  def activate(self, ssn):
+    self.active.add(ssn)
+
+  def activity(self):
+    active = self.active
+    self.active = set()
+    return active
+
   def tick(self):
-    for ch, ssn in self.outgoing.items():
-      ssn.tick()
+    dirty = self.dirty
+    self.dirty = set()
+    for ssn in dirty:
+      if ssn.channel is None:
+        continue
+      ticks, skipped = ssn.tick()
+      self.ticks += ticks
+      self.skipped += skipped
       for body in ssn.read():
         self.post_frame(ssn.channel, body)
+    self.ticks += len(dirty)
+    self.skipped += len(self.outgoing) - len(dirty)
 
   def open(self, *args, **kwargs):
     if "max_frame_size" in kwargs:
       self.max_frame_size = min(self.max_frame_size, kwargs["max_frame_size"])
+    if "channel_max" in kwargs:
+      self.channel_max = kwargs["channel_max"]
+      self.channels.limit(self.channel_max)
     open = Open(*args, **kwargs)
     self.post_frame(0, open)
     self.open_sent = True
@@ -90,9 +127,18 @@ class Connection(Dispatcher):
     else:
       self.container_id = open.container_id
       self.open_rcvd = True
+      self.channels.limit(open.channel_max)
+      if open.idle_time_out:
+        self.idle_timeout = open.idle_time_out/1000.0
     self.max_frame_size = min(self.max_frame_size,
                               open.max_frame_size or self.max_frame_size)
 
+  def idle(self):
+    if self.close_sent:
+      return None
+    else:
+      return self.idle_timeout
+
   def close(self, *args, **kwargs):
     # avoid stranding frames inside sessions
     self.tick()
@@ -105,6 +151,7 @@ class Connection(Dispatcher):
 
   def closed(self):
     Dispatcher.closed(self)
+    self.trace("io", "TICKS: %s performed, %s skipped", self.ticks, self.skipped)
     if not self.close_rcvd:
       self.exception = ConnectionError("connection aborted")
     self.close_rcvd = True
@@ -117,18 +164,27 @@ class Connection(Dispatcher):
     self.exception = exc
 
   def add(self, ssn):
-    ssn.channel = self.allocate_channel()
+    try:
+      ssn.channel = self.allocate_channel()
+    except Exhausted:
+      raise ConnectionError("no channels left, channel_max is %s" % self.channels.max)
     ssn.max_frame_size = self.max_frame_size
+    ssn.connection = self
     self.outgoing[ssn.channel] = ssn
+    self.mark(ssn)
 
   def allocate_channel(self):
-    return max([-1] + self.outgoing.keys()) + 1
+    return self.channels.allocate()
 
   def remove(self, ssn):
     # avoid stranding frames inside sessions
     self.tick()
     if ssn.channel in self.outgoing and self.outgoing[ssn.channel] == ssn:
       del self.outgoing[ssn.channel]
+      self.channels.release(ssn.channel)
+      self.dirty.discard(ssn)
+      self.active.discard(ssn)
+      ssn.connection = None
       ssn.channel = None
       ssn.max_frame_size = None
     else:
@@ -137,6 +193,8 @@ class Connection(Dispatcher):
   def do_begin(self, channel, begin):
     if channel in self.incoming:
       raise ConnectionError("double begin")
+    if channel > self.channel_max:
+      raise ConnectionError("channel %s exceeds channel_max %s" % (channel, self.channel_max))
 
     if begin.remote_channel in self.outgoing:
       ssn = self.outgoing[begin.remote_channel]
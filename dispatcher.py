@@ -17,27 +17,77 @@
 # under the License.
 #
 
-import os, struct, sys
+import os, struct, sys, time
+from collections import deque
 
-from framing import AMQP_FRAME, Frame, encode, decode
-from util import Buffer, parse
+from capture import INPUT, OUTPUT, CLOSED
+from framing import AMQP_FRAME, FRAME_HDR, FRAME_HDR_SIZE, encode_segments, \
+    decode_from
+from util import Buffer, Watermark, parse, dispatch_table
 
 
 PROTO_HDR_FMT = "!4sBBBB"
 PROTO_HDR_SIZE = struct.calcsize(PROTO_HDR_FMT)
 assert PROTO_HDR_SIZE == 8
 
+# Frames with these performatives are written ahead of any transfers
+# still waiting, as long as they don't depend on them. A flow waits for
+# the transfers queued on its own link (or its session, for a session
+# flow), since its delivery-count already counts them, and a sender's
+# disposition waits for the transfers of the deliveries it covers.
+# Every other performative (open, begin, detach, end, close) keeps its
+# place, since what follows it may depend on it or it may depend on the
+# transfers ahead of it, and nothing overtakes it.
+PRIORITY = set(["flow", "disposition", "attach"])
+
+# Tracing is checked on every frame, so the hot paths test a flag per
+# category and only build their messages once it is known they will be
+# printed. The "bin" category doesn't print frames as they go by, it
+# records a (time, direction, channel, performative, size) tuple for
+# each into a bounded ring that is dumped when the connection closes,
+# or whenever dump() is called.
+
 class Dispatcher:
 
+  ring_size = 4096
+
   def __init__(self, protocol_id, frame_type):
     self.protocol_id = protocol_id
+    self.handlers = dispatch_table(self.__class__, "unhandled")
     self.frame_type = frame_type
     self.id = "%X" % id(self)
     self._tracing = set()
+    self.ring = None
+    self.capture = None
+    self.capture_id = None
     self.tracing(*os.environ.get("AMQP_TRACE", "").split())
     self.multiline = False
     self.input = Buffer()
     self.output = Buffer(struct.pack(PROTO_HDR_FMT, "AMQP", self.protocol_id, 1, 0, 0))
+    # frames waiting to be moved onto the output: (segments, size,
+    # time, sequence, after) for urgent ones, where after is the
+    # sequence of the last transfer they must follow, and (segments,
+    # size, time, sequence, transfer) for the rest, where transfer is
+    # (channel, handle, delivery_id) for transfers
+    self.urgent = deque()
+    self.frames = deque()
+    # the sequence of the last transfer queued on each (channel, handle)
+    # and on each (channel, None)
+    self.last_transfer = {}
+    # channel -> (delivery_id, sequence) of each transfer queued on it
+    self.queued_deliveries = {}
+    # (channel, handle) -> the delivery_id continuation transfers belong to
+    self.current_delivery = {}
+    # sequence numbers of the frames that nothing may overtake
+    self.barriers = deque()
+    self.sequence = 0
+    self.queued = 0
+    # set by throttle
+    self.watermark = None
+    # how many urgent frames were written and how long they waited
+    self.urgent_frames = 0
+    self.urgent_wait = 0.0
+    self.urgent_wait_max = 0.0
 
     self.state = self.__proto_header
 
@@ -48,6 +98,12 @@ class Dispatcher:
     if "err" not in kwargs:
       names.add("err")
     self._tracing = names
+    self.tracing_raw = "raw" in names
+    self.tracing_frm = "frm" in names
+    if "bin" not in names:
+      self.ring = None
+    elif self.ring is None:
+      self.ring = deque(maxlen=self.ring_size)
 
   def trace(self, categories, format, *args):
     if isinstance(categories, basestring):
@@ -63,17 +119,57 @@ class Dispatcher:
             message.replace(os.linesep, "%s%s " % (os.linesep, prefix))
         break
 
+  # Records every byte read and written to a capture.Capture. Only the
+  # outermost dispatcher of a connection should be capturing.
+
+  def capturing(self, capture):
+    self.capture = capture
+    if capture is None:
+      self.capture_id = None
+    else:
+      self.capture_id = capture.identify()
+
+  def captured(self, direction, bytes):
+    self.capture.record(self.capture_id, direction, bytes)
+
+  def dump(self):
+    if self.ring:
+      for when, dir, channel, name, size in self.ring:
+        self.trace("bin", "%.6f %s[%s]: %s %s", when, dir, channel, name, size)
+      self.ring.clear()
+
   def write(self, bytes):
-    self.trace("raw", "RECV: %r", bytes)
+    if self.tracing_raw:
+      self.trace("raw", "RECV: %r", bytes)
+    if self.capture is not None:
+      self.captured(INPUT, bytes)
     self.input.write(bytes)
     self.state = parse(self.state)
 
   def closed(self):
     self.trace(("raw", "frm"), "CLOSED")
+    if self.capture is not None:
+      self.captured(CLOSED, "")
+    self.dump()
 
   def error(self, exc):
     pass
 
+  # the longest the peer will wait to hear from us, in seconds, if it
+  # asked for a limit
+
+  def idle(self):
+    return None
+
+  # an empty frame, just to show we're still here
+
+  def heartbeat(self):
+    segments = encode_segments(self.frame_type, 0, None, [])
+    self.sequence += 1
+    self.frames.append((segments, FRAME_HDR_SIZE, None, self.sequence, None))
+    self.queued += FRAME_HDR_SIZE
+    self.throttled()
+
   def __proto_header(self):
     if self.input.pending() >= PROTO_HDR_SIZE:
       hdr = self.input.read(PROTO_HDR_SIZE)
@@ -83,39 +179,188 @@ class Dispatcher:
       else:
         raise ValueError("bad protocol header")
 
+  # Every complete frame in the input is decoded in place, and only what
+  # is left over once we're done is kept. Until the first frame is
+  # complete we only look at its header, so a large frame arriving in
+  # many reads isn't joined again on every one of them.
+
   def __framing(self):
-    while True:
-      f, n = decode(self.input.peek())
-      if f:
-        self.input.read(n)
-        state = self.process_frame(f)
-        if state is not None:
-          return state
-      else:
-        break
+    pending = self.input.pending()
+    if pending < FRAME_HDR_SIZE:
+      return
+    size = FRAME_HDR.unpack(self.input.peek(FRAME_HDR_SIZE))[0]
+    if pending < size:
+      return
+    bytes = self.input.view()
+    offset = 0
+    try:
+      while True:
+        f, offset = decode_from(bytes, offset)
+        if f:
+          state = self.process_frame(f)
+          if state is not None:
+            return state
+        else:
+          break
+    finally:
+      self.input.read(offset)
 
   def process_frame(self, f):
-    body, remainder = self.type_decoder.decode(f.payload)
-    body.payload = remainder
-    self.trace("frm", "RECV[%s]: %s", f.channel, body.format(self.multiline))
-    return getattr(self, "do_%s" % body.NAME, self.unhandled)(f.channel, body)
+    # an empty frame is only a heartbeat
+    if not len(f.payload):
+      return None
+    body, offset = self.type_decoder.decode_from(f.payload)
+    payload = f.payload[offset:]
+    # the payload outlives the input it was decoded from
+    if isinstance(payload, memoryview):
+      payload = payload.tobytes()
+    body.payload = payload
+    if self.tracing_frm:
+      self.trace("frm", "RECV[%s]: %s", f.channel, body.format(self.multiline))
+    if self.ring is not None:
+      self.ring.append((time.time(), "RECV", f.channel, body.NAME,
+                        FRAME_HDR_SIZE + len(f.extended or "") + len(f.payload)))
+    return self.handlers[body.__class__](self, f.channel, body)
 
   def post_frame(self, channel, body):
-    self.trace("frm", "SENT[%s]: %s", channel, body.format(self.multiline))
-    encoded = self.type_encoder.encode(body)
-    if body.payload: encoded += body.payload
-    f = Frame(self.frame_type, channel, None, encoded)
-    self.output.write(encode(f))
+    if self.tracing_frm:
+      self.trace("frm", "SENT[%s]: %s", channel, body.format(self.multiline))
+    segments = [self.type_encoder.encode(body)]
+    if body.payload: segments.append(body.payload)
+    segments = encode_segments(self.frame_type, channel, None, segments)
+    size = sum([len(seg) for seg in segments])
+    self.sequence += 1
+    if body.NAME in PRIORITY:
+      after = self.depends(channel, body)
+      self.urgent.append((segments, size, time.time(), self.sequence, after))
+    elif body.NAME == "transfer":
+      transfer = self.queue_transfer(channel, body)
+      self.frames.append((segments, size, None, self.sequence, transfer))
+    else:
+      self.barriers.append(self.sequence)
+      self.frames.append((segments, size, None, self.sequence, None))
+    self.queued += size
+    self.throttled()
+    if self.ring is not None:
+      self.ring.append((time.time(), "SENT", channel, body.NAME, size))
+
+  def queue_transfer(self, channel, xfr):
+    link = (channel, xfr.handle)
+    if xfr.delivery_id is None:
+      id = self.current_delivery.get(link)
+    else:
+      id = xfr.delivery_id
+      self.current_delivery[link] = id
+    self.last_transfer[link] = self.sequence
+    self.last_transfer[(channel, None)] = self.sequence
+    if id is not None:
+      self.queued_deliveries.setdefault(channel, deque()).append((id, self.sequence))
+    return channel, xfr.handle, id
+
+  def promoted_transfer(self, seq, transfer):
+    channel, handle, id = transfer
+    for key in ((channel, handle), (channel, None)):
+      if self.last_transfer.get(key) == seq:
+        del self.last_transfer[key]
+    if id is not None:
+      deliveries = self.queued_deliveries[channel]
+      deliveries.popleft()
+      if not deliveries:
+        del self.queued_deliveries[channel]
+
+  # the sequence of the last queued transfer body must not overtake,
+  # or 0 when it may overtake them all
+
+  def depends(self, channel, body):
+    if body.NAME == "flow":
+      return self.last_transfer.get((channel, body.handle), 0)
+    elif body.NAME == "disposition" and not body.role:
+      # only a sender's disposition is about the deliveries we send
+      deliveries = self.queued_deliveries.get(channel)
+      if not deliveries:
+        return 0
+      if body.last is None:
+        last = body.first
+      else:
+        last = body.last
+      # delivery ids are queued in order, so the first tells us if any
+      # are covered and the last one covered is found from the end
+      if deliveries[0][0] > last:
+        return 0
+      for id, seq in reversed(deliveries):
+        if id <= last:
+          return seq
+    return 0
+
+  # Moves whole frames onto the output, urgent ones first, until it
+  # holds at least limit bytes. The output only ever ends at a frame
+  # boundary, so this is where urgent frames overtake transfers.
+
+  def promote(self, limit=None):
+    while limit is None or self.output.pending() < limit:
+      if self.urgent and \
+            (not self.barriers or self.barriers[0] > self.urgent[0][3]) and \
+            (not self.frames or self.frames[0][3] > self.urgent[0][4]):
+        segments, size, queued, seq, after = self.urgent.popleft()
+        wait = time.time() - queued
+        self.urgent_frames += 1
+        self.urgent_wait += wait
+        self.urgent_wait_max = max(self.urgent_wait_max, wait)
+      elif self.frames:
+        segments, size, queued, seq, transfer = self.frames.popleft()
+        if self.barriers and self.barriers[0] == seq:
+          self.barriers.popleft()
+        elif transfer is not None:
+          self.promoted_transfer(seq, transfer)
+      else:
+        break
+      self.queued -= size
+      self.output.extend(segments)
 
   def read(self, n=None):
     self.tick()
+    self.promote(n)
     result = self.output.read(n)
-    self.trace("raw", "SENT: %r", result)
+    self.throttled()
+    if self.tracing_raw:
+      self.trace("raw", "SENT: %r", result)
+    if self.capture is not None:
+      self.captured(OUTPUT, result)
     return result
 
   def peek(self, n=None):
+    self.promote(n)
     return self.output.peek(n)
 
+  def segments(self, limit=None, count=None):
+    self.promote(limit)
+    return self.output.gather(limit, count)
+
+  def consume(self, n):
+    if self.tracing_raw or self.capture is not None:
+      bytes = self.output.peek(n)
+      if self.tracing_raw:
+        self.trace("raw", "SENT: %r", bytes)
+      if self.capture is not None:
+        self.captured(OUTPUT, bytes)
+    self.output.consume(n)
+    self.throttled()
+
   def pending(self):
     self.tick()
-    return self.output.pending()
+    return self.output.pending() + self.queued
+
+  # Pauses producers once the output and the frames queued behind it
+  # hold capacity bytes or more, until they drain back down to low.
+  # Producers can either poll paused or pass callbacks.
+
+  def throttle(self, capacity, low=None, pause=None, resume=None):
+    self.watermark = Watermark(capacity, low, pause, resume)
+    self.throttled()
+
+  def throttled(self):
+    if self.watermark is not None:
+      self.watermark.update(self.output.pending() + self.queued)
+
+  def paused(self):
+    return self.watermark is not None and self.watermark.paused
@@ -25,6 +25,7 @@ SASL_FRAME = 0x01
 FRAME_HDR_FMT = "!I2BH"
 FRAME_HDR_SIZE = struct.calcsize(FRAME_HDR_FMT)
 assert FRAME_HDR_SIZE == 8
+FRAME_HDR = struct.Struct(FRAME_HDR_FMT)
 
 class Frame:
 
@@ -39,13 +40,20 @@ class Frame:
         (self.type, self.channel, self.extended, self.payload)
 
 def encode(frame):
-  extended = frame.extended or ""
+  return "".join(encode_segments(frame.type, frame.channel, frame.extended,
+                                 [frame.payload]))
+
+# Encodes a frame as a list of segments, the header and extended header
+# followed by the segments of the payload, which are left as they are.
+
+def encode_segments(type, channel, extended, payload):
+  extended = extended or ""
   padd = len(extended) % 4
   if padd: extended += "\x00"*(4-padd)
-  size = FRAME_HDR_SIZE + len(extended) + len(frame.payload)
+  size = FRAME_HDR_SIZE + len(extended) + sum([len(seg) for seg in payload])
   doff = (FRAME_HDR_SIZE + len(extended))/4
-  header = struct.pack(FRAME_HDR_FMT, size, doff, frame.type, frame.channel)
-  return "%s%s%s" % (header, extended, frame.payload)
+  header = FRAME_HDR.pack(size, doff, type, channel)
+  return [header + extended] + payload
 
 def decode(bytes):
   if len(bytes) >= FRAME_HDR_SIZE:
@@ -56,3 +64,19 @@ def decode(bytes):
       payload = bytes[doff*4:size]
       return Frame(type, channel, extended, payload), size
   return None, 0
+
+# Decodes the frame starting at offset, returning it along with the
+# offset just past it, or None and the original offset if the frame
+# isn't complete. Given a memoryview the extended header and payload of
+# the frame are views into it, so decoding every frame in a buffer
+# never copies any of it.
+
+def decode_from(bytes, offset=0):
+  if len(bytes) - offset >= FRAME_HDR_SIZE:
+    size, doff, type, channel = FRAME_HDR.unpack_from(bytes, offset)
+    end = offset + size
+    if len(bytes) >= end:
+      extended = bytes[offset + FRAME_HDR_SIZE:offset + doff*4]
+      payload = bytes[offset + doff*4:end]
+      return Frame(type, channel, extended, payload), end
+  return None, offset
@@ -18,7 +18,7 @@
 #
 
 from protocol import Attach, Flow, Transfer, Disposition, Detach, Binary
-from util import Constant, RangeSet
+from util import Constant, RangeSet, Serial, SERIAL_START, dispatch_table
 from uuid import uuid4
 
 class LinkError(Exception):
@@ -45,6 +45,7 @@ class Link(object):
 
   def __init__(self, name, source=None, target=None):
     self.name = name
+    self.handlers = dispatch_table(self.__class__)
     self.source = source
     self.target = target
     self.remote_source = None
@@ -90,11 +91,25 @@ class Link(object):
   def detached(self):
     return self.detach_sent and self.detach_rcvd
 
+  # anything that gives tick something to do marks the link so that
+  # its session ticks it
+
+  def mark(self):
+    if self.session is not None:
+      self.session.mark(self)
+
+  # anything the peer does that the application may need to act on
+  # activates the link, so the application can visit just those links
+
+  def activate(self):
+    if self.session is not None:
+      self.session.activate(self)
+
   def write(self, body):
     self.dispatch(body)
 
   def dispatch(self, body):
-    return getattr(self, "do_%s" % body.NAME)(body)
+    return self.handlers[body.__class__](self, body)
 
   def post_frame(self, body):
     assert self.attach_sent and not self.detach_sent
@@ -135,11 +150,12 @@ class Link(object):
                            unsettled = unsettled))
     if self.role == Receiver.role:
       self.post_frame(self._flow())
+    self.mark()
 
   def do_attach(self, attach):
     self.attach_rcvd = True
-    if self.role == Receiver.role:
-      self.delivery_count = attach.initial_delivery_count
+    if self.role == Receiver.role and attach.initial_delivery_count is not None:
+      self.delivery_count = Serial(attach.initial_delivery_count)
     self.remote_source = attach.source
     self.remote_target = attach.target
     self.snd_settle_mode = attach.snd_settle_mode
@@ -152,6 +168,8 @@ class Link(object):
           remote.modified = True
         else:
           self.unsettled[tag] = State(resumed=True), State(state, modified=True)
+    self.mark()
+    self.activate()
 
   # XXX: closing and errors
   def detach(self, closed=False):
@@ -161,6 +179,7 @@ class Link(object):
     self.tick()
     self.post_frame(Detach(closed=closed))
     self.detach_sent = True
+    self.session.free_handle(self.handle)
     self.handle = None
 
   def close(self):
@@ -173,6 +192,7 @@ class Link(object):
     if detach.closed:
       self.remote_source = None
       self.remote_target = None
+    self.activate()
 
   def do_disposition(self, delivery_tag, state, settled):
     if delivery_tag in self.unsettled:
@@ -180,10 +200,14 @@ class Link(object):
       remote.state = state
       remote.settled = settled
       remote.modified = True
+      self.activate()
 
   def do_flow(self, flow):
     self.do_flow_state(flow)
     self.echo = self.echo or flow.echo
+    if self.echo:
+      self.mark()
+    self.activate()
 
   def _query(self, index, settled=None, modified=None):
     return [(delivery_tag, pair[0], pair[1])
@@ -211,12 +235,14 @@ class Link(object):
       local.resumed = False
     else:
       self.unsettled[delivery_tag] = (State(state), State())
+    self.mark()
 
   def disposition(self, delivery_tag, state=None, settled=False):
     local, remote = self.unsettled[delivery_tag]
     local.state = state
     local.settled = settled
     local.modified = True
+    self.mark()
     # XXX
     if local.settled and self.handle is None:
       self.unsettled.pop(delivery_tag)
@@ -268,7 +294,7 @@ class Sender(Link):
 
   # XXX
   role = False
-  initial_count = 0
+  initial_count = SERIAL_START
 
   def init(self):
     self.delivery_count = self.initial_count
@@ -277,7 +303,7 @@ class Sender(Link):
     if state.delivery_count is None:
       receiver_count = self.initial_count
     else:
-      receiver_count = state.delivery_count
+      receiver_count = Serial(state.delivery_count)
     self.link_credit = receiver_count + state.link_credit - self.delivery_count
     self.drain = state.drain
 
@@ -344,6 +370,10 @@ class Receiver(Link):
     self.incoming = []
     self.tag = None
     self.payloads = []
+    # when set to a codec.StreamDecoder payloads are written to it as
+    # each transfer arrives rather than joined once the delivery is
+    # complete, and the delivery's own payload is left empty
+    self.stream = None
 
   def do_transfer(self, xfr):
     self.session.incoming.append(self, xfr)
@@ -355,7 +385,10 @@ class Receiver(Link):
       raise ValueError("mismatched tags: %s, %s" % (self.tag, xfr.delivery_tag))
 
     if xfr.payload:
-      self.payloads.extend(xfr.payload)
+      if self.stream is None:
+        self.payloads.extend(xfr.payload)
+      else:
+        self.stream.write(xfr.payload)
 
     if not xfr.more:
       self.tag = None
@@ -374,11 +407,14 @@ class Receiver(Link):
       self.link_credit -= 1
       self.delivery_count += 1
       self.available = max(0, self.available - 1)
+      self.activate()
 
   def do_flow_state(self, state):
-    if self.delivery_count is not None:
-      self.link_credit -= state.delivery_count - self.delivery_count
-    self.delivery_count = state.delivery_count
+    if state.delivery_count is not None:
+      count = Serial(state.delivery_count)
+      if self.delivery_count is not None:
+        self.link_credit -= count - self.delivery_count
+      self.delivery_count = count
     if state.available is not None:
       self.available = state.available
 
@@ -386,6 +422,7 @@ class Receiver(Link):
     self.link_credit += n
     self.drain = drain
     self.echo = True
+    self.mark()
 
   def drain(self):
     self.flow(0, True)
@@ -85,24 +85,24 @@ class Message:
 
 def encode(message):
   encoder = PROTOCOL_ENCODER
-  encoded = ""
+  encoded = bytearray()
   if message.header:
-    encoded += encoder.encode(message.header)
+    encoder.encode_into(encoded, message.header)
   if message.properties:
-    encoded += encoder.encode(message.properties)
+    encoder.encode_into(encoded, message.properties)
   if message.application_properties:
-    encoded += encoder.encode(ApplicationProperties(message.application_properties))
+    encoder.encode_into(encoded, ApplicationProperties(message.application_properties))
   if message.content is not None:
     # XXX: should dispatch
     if isinstance(message.content, str):
-      encoded += encoder.encode(Data(message.content))
+      encoder.encode_into(encoded, Data(message.content))
     elif isinstance(message.content, (list, tuple)):
-      encoded += encoder.encode(AmqpSequence(message.content))
+      encoder.encode_into(encoded, AmqpSequence(message.content))
     else:
-      encoded += encoder.encode(AmqpValue(message.content))
+      encoder.encode_into(encoded, AmqpValue(message.content))
   if message.footer:
-    encoded += encoder.encode(message.footer)
-  return encoded
+    encoder.encode_into(encoded, message.footer)
+  return str(encoded)
 
 def process_header(msg, header):
   msg.header = header
@@ -143,15 +143,26 @@ SECTION_PROCESSORS = {
   Footer: process_footer
   }
 
-def decode(transfer):
+SECTIONS = {}
+for cls in SECTION_PROCESSORS:
+  for d in cls.DESCRIPTORS:
+    SECTIONS[d] = cls
+
+def sections(payload):
+  result = []
+  offset = 0
+  while offset < len(payload):
+    code, descriptor, end = PROTOCOL_DECODER.skip(payload, offset)
+    result.append((SECTIONS.get(descriptor), offset, end))
+    offset = end
+  return result
+
+def decode(transfer, kinds=None):
   message = Message()
   message.delivery_tag = transfer.delivery_tag
-  remaining = transfer.payload
-  sections = []
-  while remaining:
-    sect, remaining = PROTOCOL_DECODER.decode(remaining)
-    sections.append(sect)
-  while sections:
-    sect = sections.pop(0)
-    SECTION_PROCESSORS[sect.__class__](message, sect)
+  payload = transfer.payload
+  for cls, start, end in sections(payload):
+    if kinds is None or cls in kinds:
+      sect, _ = PROTOCOL_DECODER.decode_from(payload, start)
+      SECTION_PROCESSORS[sect.__class__](message, sect)
   return message
@@ -17,6 +17,7 @@
 # under the License.
 #
 
+from capture import OUTPUT, CLOSED
 from dispatcher import Dispatcher
 from framing import SASL_FRAME
 from protocol import *
@@ -92,8 +93,58 @@ class SASL(Dispatcher):
     raise ValueError("unknown boyd: %s" % body);
 
   def tick(self):
+    pass
+
+  # Once authenticated, the connection's output follows straight on
+  # from whatever of our own is left.
+
+  def redirected(self):
+    return self.output_redirect and not (self.output.pending() or self.queued)
+
+  def pending(self):
+    result = Dispatcher.pending(self)
     if self.output_redirect:
-      self.output.write(self.connection.read())
+      result += self.connection.pending()
+    return result
+
+  def read(self, n=None):
+    if self.redirected():
+      result = self.connection.read(n)
+      if self.capture is not None:
+        self.captured(OUTPUT, result)
+      return result
+    else:
+      return Dispatcher.read(self, n)
+
+  def peek(self, n=None):
+    if self.redirected():
+      return self.connection.peek(n)
+    else:
+      return Dispatcher.peek(self, n)
+
+  def segments(self, limit=None, count=None):
+    if self.redirected():
+      return self.connection.segments(limit, count)
+    else:
+      return Dispatcher.segments(self, limit, count)
+
+  def idle(self):
+    if self.output_redirect:
+      return self.connection.idle()
+    else:
+      return None
+
+  def heartbeat(self):
+    if self.output_redirect:
+      self.connection.heartbeat()
+
+  def consume(self, n):
+    if self.redirected():
+      if self.capture is not None:
+        self.captured(OUTPUT, self.connection.peek(n))
+      self.connection.consume(n)
+    else:
+      Dispatcher.consume(self, n)
 
   def __tunnel(self):
     self.connection.write(self.input.read())
@@ -103,5 +154,8 @@ class SASL(Dispatcher):
       self.connection.error(exc)
 
   def closed(self):
+    if self.capture is not None:
+      self.captured(CLOSED, "")
+    self.dump()
     if self.output_redirect:
       self.connection.closed()
@@ -16,10 +16,10 @@
 # specific language governing permissions and limitations
 # under the License.
 #
-import atexit, time
+import atexit, math, time
 from select import select
 from concurrency import selectable_waiter
-from threading import Thread, Lock
+from threading import Thread, Lock, currentThread
 
 class Acceptor:
 
@@ -36,13 +36,188 @@ class Acceptor:
   def writing(self):
     return False
 
-  def timing(self):
-    return None
+  def registered(self, selector):
+    pass
 
   def readable(self, selector):
     sock, addr = self.sock.accept()
     self.handler(sock, selector)
 
+# A Timer calls back once its deadline has passed, unless it is
+# cancelled first.
+
+class Timer:
+
+  def __init__(self, wheel, deadline, callback):
+    self.wheel = wheel
+    self.deadline = deadline
+    self.callback = callback
+    self.cancelled = False
+    self.fired = False
+
+  def cancel(self):
+    self.wheel.lock.acquire()
+    try:
+      if not (self.cancelled or self.fired):
+        self.cancelled = True
+        self.wheel.count -= 1
+    finally:
+      self.wheel.lock.release()
+
+  def __repr__(self):
+    return "Timer(%s, %s)" % (self.deadline, self.callback)
+
+# A hierarchical timer wheel. Time is counted in ticks of resolution
+# seconds. The first wheel has a slot for each of the next 256 ticks,
+# each wheel above it a slot for each of the next 256 slots of the one
+# below, and anything further out than all of them waits in overflow.
+# Scheduling appends to a slot and cancelling only marks the timer, so
+# both are O(1). Each time the first wheel comes round the next slot of
+# the one above is cascaded down into it.
+#
+# Timers may be scheduled and cancelled from any thread, so the wheel
+# is guarded by a lock. Callbacks are made outside of it, leaving them
+# free to schedule and cancel timers of their own.
+
+BITS = 8
+SLOTS = 1 << BITS
+MASK = SLOTS - 1
+LEVELS = 4
+
+class TimerWheel:
+
+  def __init__(self, resolution=0.001, now=None):
+    self.resolution = resolution
+    if now is None:
+      now = time.time()
+    # the next tick to expire
+    self.current = int(now/resolution)
+    self.wheels = [[[] for i in range(SLOTS)] for l in range(LEVELS)]
+    # how many timers each wheel holds, cancelled or not
+    self.sizes = [0]*LEVELS
+    self.overflow = []
+    # timers scheduled and neither fired nor cancelled
+    self.count = 0
+    self.lock = Lock()
+
+  def schedule(self, deadline, callback):
+    timer = Timer(self, deadline, callback)
+    self.lock.acquire()
+    try:
+      self.count += 1
+      self.add(timer)
+    finally:
+      self.lock.release()
+    return timer
+
+  def add(self, timer):
+    # a timer is due on the first tick that starts at or after it
+    expires = max(int(math.ceil(timer.deadline/self.resolution)), self.current)
+    delta = expires - self.current
+    for level in range(LEVELS):
+      if delta < 1 << (BITS*(level + 1)):
+        self.wheels[level][(expires >> (BITS*level)) & MASK].append(timer)
+        self.sizes[level] += 1
+        return
+    self.overflow.append(timer)
+
+  def cascade(self, level):
+    idx = (self.current >> (BITS*level)) & MASK
+    if idx == 0:
+      if level + 1 < LEVELS:
+        self.cascade(level + 1)
+      else:
+        timers = self.overflow
+        self.overflow = []
+        for t in timers:
+          if not t.cancelled:
+            self.add(t)
+    slot = self.wheels[level][idx]
+    if slot:
+      self.wheels[level][idx] = []
+      self.sizes[level] -= len(slot)
+      for t in slot:
+        if not t.cancelled:
+          self.add(t)
+
+  # Fires every timer due by now, returning how many fired.
+
+  def expire(self, now=None):
+    if now is None:
+      now = time.time()
+    target = int(now/self.resolution)
+    self.lock.acquire()
+    try:
+      due = self.due(target)
+    finally:
+      self.lock.release()
+    for t in due:
+      t.callback()
+    return len(due)
+
+  # Advances the wheel through target, returning the timers that came
+  # due on the way.
+
+  def due(self, target):
+    due = []
+    if not self.count:
+      # nothing to cascade, so we can skip straight there
+      self.current = max(self.current, target + 1)
+      return due
+    while self.current <= target:
+      idx = self.current & MASK
+      if idx == 0:
+        self.cascade(1)
+      if not self.sizes[0]:
+        # nothing can happen until the lowest wheel holding anything
+        # next cascades, so skip straight there
+        level = 1
+        while level < LEVELS and not self.sizes[level]:
+          level += 1
+        span = 1 << (BITS*level)
+        self.current = min(target + 1, (self.current | (span - 1)) + 1)
+        continue
+      slot = self.wheels[0][idx]
+      self.current += 1
+      if slot:
+        self.wheels[0][idx] = []
+        self.sizes[0] -= len(slot)
+        for t in slot:
+          if not t.cancelled:
+            t.fired = True
+            self.count -= 1
+            due.append(t)
+    return due
+
+  # When expire next has something to do: either the earliest timer in
+  # the first wheel, or when the lowest wheel holding anything next
+  # cascades.
+
+  def deadline(self):
+    self.lock.acquire()
+    try:
+      return self.next()
+    finally:
+      self.lock.release()
+
+  def next(self):
+    if not self.count:
+      return None
+    if not self.sizes[0]:
+      level = 1
+      while level < LEVELS and not self.sizes[level]:
+        level += 1
+      span = 1 << (BITS*level)
+      return ((self.current | (span - 1)) + 1)*self.resolution
+    tick = self.current
+    while True:
+      for t in self.wheels[0][tick & MASK]:
+        if not t.cancelled:
+          return tick*self.resolution
+      tick += 1
+      if tick & MASK == 0:
+        return tick*self.resolution
+
 class Selector:
 
   lock = Lock()
@@ -69,12 +244,24 @@ class Selector:
     self.reading.add(self.waiter)
     self.stopped = False
     self.thread = None
+    self.running = None
+    self.timers = TimerWheel()
+
+  # Calls back at deadline from within the selector's loop, returning a
+  # Timer that may be cancelled.
+
+  def schedule(self, deadline, callback):
+    timer = self.timers.schedule(deadline, callback)
+    if self.running is not currentThread():
+      self.wakeup()
+    return timer
 
   def wakeup(self):
     self.waiter.wakeup()
 
   def register(self, selectable):
     self.selectables.add(selectable)
+    selectable.registered(self)
     self.modify(selectable)
 
   def _update(self, selectable):
@@ -86,7 +273,6 @@ class Selector:
       self.writing.add(selectable)
     else:
       self.writing.discard(selectable)
-    return selectable.timing()
 
   def modify(self, selectable):
     self._update(selectable)
@@ -105,16 +291,12 @@ class Selector:
     self.thread.start();
 
   def run(self, idle=None, period=None):
+    self.running = currentThread()
     while not self.stopped:
-      wakeup = None
       for sel in self.selectables.copy():
-        t = self._update(sel)
-        if t is not None:
-          if wakeup is None:
-            wakeup = t
-          else:
-            wakeup = min(wakeup, t)
+        self._update(sel)
 
+      wakeup = self.timers.deadline()
       if wakeup is None:
         timeout = period
       else:
@@ -135,12 +317,8 @@ class Selector:
           sel.readable(self)
           is_idle = False
 
-      now = time.time()
-      for sel in self.selectables.copy():
-        w = sel.timing()
-        if w is not None and now > w:
-          sel.timeout(self)
-          is_idle = False
+      if self.timers.expire():
+        is_idle = False
 
       if is_idle and idle:
         idle()
@@ -19,7 +19,8 @@
 
 from link import Sender, Receiver
 from protocol import Begin, End, Flow
-from util import RangeSet, Constant
+from util import RangeSet, Constant, Serial, SERIAL_START, dispatch_table, \
+    Allocator, Exhausted
 
 SLIDING = Constant("SLIDING")
 FIXED = Constant("FIXED")
@@ -32,9 +33,13 @@ class Session:
   def __init__(self, factory, properties=None):
     self.factory = factory
     self.properties = properties
+    self.handlers = dispatch_table(self.__class__, "unhandled")
+    self.connection = None
     self.remote_channel = None
     self.channel = None
     self.max_frame_size = None
+    # the highest incoming handle we accept
+    self.handle_max = 2147483647
 
     self.begin_sent = False
     self.begin_rcvd = False
@@ -51,8 +56,18 @@ class Session:
     self.links = {}
     # handle -> link endpoint
     self.handles = {}
+    # our own handles, limited by the peer's handle_max
+    self.local_handles = Allocator(4294967295)
 
     self.output = []
+    # links with work for tick to do, and how many links tick visited or
+    # had no reason to
+    self.dirty = set()
+    self.ticks = 0
+    self.skipped = 0
+    # links the peer has done something to since activity was last
+    # called
+    self.active = set()
 
   def write(self, body):
     self.dispatch(body)
@@ -64,7 +79,7 @@ class Session:
     return result
 
   def dispatch(self, body):
-    getattr(self, "do_%s" % body.NAME, self.unhandled)(body)
+    self.handlers[body.__class__](self, body)
 
   def unhandled(self, body):
     link = self.handles[body.handle]
@@ -73,6 +88,25 @@ class Session:
   def post_frame(self, body):
     assert self.begin_sent and not self.end_sent
     self.output.append(body)
+    if self.connection is not None:
+      self.connection.mark(self)
+
+  def mark(self, link=None):
+    if link is not None:
+      self.dirty.add(link)
+    if self.connection is not None:
+      self.connection.mark(self)
+
+  def activate(self, link=None):
+    if link is not None:
+      self.active.add(link)
+    if self.connection is not None:
+      self.connection.activate(self)
+
+  def activity(self):
+    active = self.active
+    self.active = set()
+    return active
 
   def beginning(self):
     return self.begin_rcvd and not self.begin_sent
@@ -88,13 +122,15 @@ class Session:
                           next_outgoing_id = self.outgoing.unsettled_hwm + 1,
                           incoming_window = self.incoming.window,
                           outgoing_window = 65536, # this should NOT be self.outgoing.window
-                          handle_max = 2147483647,
+                          handle_max = self.handle_max,
                           properties = self.properties))
 
   def do_begin(self, begin):
     self.begin_rcvd = True
-    self.incoming.transfer_count = begin.next_outgoing_id - 1
+    self.local_handles.limit(begin.handle_max)
+    self.incoming.transfer_count = Serial(begin.next_outgoing_id) - 1
     self.outgoing.max_id = self.outgoing.transfer_count + begin.incoming_window - 1
+    self.activate()
 
   def end(self, error=None):
     if self.end_sent:
@@ -106,13 +142,20 @@ class Session:
 
   def do_end(self, det):
     self.end_rcvd = True
+    self.activate()
 
   def add(self, link):
     link.session = self
     self.links[link.name] = link
 
   def allocate_handle(self):
-    return max([-1] + [l.handle for l in self.links.values()]) + 1
+    try:
+      return self.local_handles.allocate()
+    except Exhausted:
+      raise SessionError("no handles left, handle_max is %s" % self.local_handles.max)
+
+  def free_handle(self, handle):
+    self.local_handles.release(handle)
 
   def remove(self, link):
     # process any outstanding work before removing
@@ -121,6 +164,8 @@ class Session:
       raise SessionError("link is attached")
     if link.name in self.links and self.links[link.name] == link:
       del self.links[link.name]
+      self.dirty.discard(link)
+      self.active.discard(link)
       link.session = None
     else:
       raise SessionError("no such link")
@@ -128,6 +173,8 @@ class Session:
   def do_attach(self, attach):
     if attach.handle in self.handles:
       raise SessionError("double attach")
+    if attach.handle > self.handle_max:
+      raise SessionError("handle %s exceeds handle_max %s" % (attach.handle, self.handle_max))
 
     if self.links.has_key(attach.name):
       link = self.links[attach.name]
@@ -147,23 +194,31 @@ class Session:
 
   def do_disposition(self, disp):
     role = self.roles[not disp.role]
-    start = max(role.unsettled_lwm, disp.first)
+    first = Serial(disp.first)
     if disp.last is None:
-      last = start + 1
+      last = first
     else:
-      last = disp.last + 1
-    for id in range(start, last):
-      delivery = role.get_delivery(id)
-      if delivery:
-        link, tag = delivery
-        link.do_disposition(tag, disp.state, disp.settled)
+      last = Serial(disp.last)
+    # only visit the unsettled ids within the range, settling as we go
+    for r in list(role.unsettled.between(first, last)):
+      for id in r:
+        delivery = role.get_delivery(id)
+        if delivery:
+          link, tag = delivery
+          link.do_disposition(tag, disp.state, disp.settled)
 
   def do_flow(self, flow):
     if flow.next_incoming_id is None:
       start = Outgoing.initial_transfer
     else:
-      start = flow.next_incoming_id
+      start = Serial(flow.next_incoming_id)
+    blocked = self.outgoing.window <= 0
     self.outgoing.window = start + flow.incoming_window - self.outgoing.unsettled_hwm - 1
+    if blocked and self.outgoing.window > 0:
+      # every sender was held up by the window, not just this link
+      for link in self.links.values():
+        if link.role == Sender.role:
+          link.activate()
     if flow.handle is not None:
       link = self.handles[flow.handle]
       link.write(flow)
@@ -186,8 +241,14 @@ class Session:
                            incoming_window = self.incoming.window))
 
   def tick(self):
-    for link in self.links.values():
+    dirty = self.dirty
+    self.dirty = set()
+    for link in dirty:
       link.tick()
+    skipped = len(self.links) - len(dirty)
+    self.ticks += len(dirty)
+    self.skipped += skipped
+    return len(dirty), skipped
 
   def update_next_receiver(self, xfr):
     if xfr.delivery_id == self.next_receiver_id:
@@ -200,8 +261,12 @@ class Session:
     while True:
       d = self.incoming.get_delivery(self.next_receiver_id)
       if d:
-        return d[0]
-      elif self.next_receiver_id < self.unsettled_hwm:
+        # the delivery isn't handed out until its last transfer is in
+        if d[0].pending():
+          return d[0]
+        else:
+          return None
+      elif self.next_receiver_id < self.incoming.unsettled_hwm:
         self.next_receiver_id += 1
       else:
         return None
@@ -211,8 +276,10 @@ class DeliveryMap:
   def __init__(self):
     # (link, delivery_tag) -> delivery_id
     self.aliases = {}
-    # (delivery_id - unsettled_lwm) -> (link, delivery_tag)
-    self.deliveries = []
+    # delivery_id -> (link, delivery_tag)
+    self.deliveries = {}
+    # unsettled delivery_ids
+    self.unsettled = RangeSet()
     # lowest unsettled delivery_id
     self.unsettled_lwm = None
     # highest unsettled delivery_id
@@ -235,28 +302,26 @@ class DeliveryMap:
     else:
       self.mark(transfer)
       self.aliases[delivery] = transfer.delivery_id
-      self.deliveries.append(delivery)
+      self.deliveries[transfer.delivery_id] = delivery
+      self.unsettled.add(transfer.delivery_id)
     self.transfer_count += 1
 
   def settle(self, link, delivery_tag):
     delivery = (link, delivery_tag)
     id = self.aliases.pop(delivery)
-    idx = id - self.unsettled_lwm
-    assert self.deliveries[idx] == delivery
-    self.deliveries[idx] = None
-
-    while self.deliveries:
-      if self.deliveries[0] is None:
-        self.deliveries.pop(0)
-        self.unsettled_lwm += 1
-      else:
-        break
+    d = self.deliveries.pop(id)
+    assert d == delivery
+    self.unsettled.remove(id)
+    if self.unsettled.empty():
+      self.unsettled_lwm = self.unsettled_hwm + 1
+    else:
+      self.unsettled_lwm = self.unsettled.min()
 
   def get_delivery(self, delivery_id):
-    return self.deliveries[delivery_id - self.unsettled_lwm]
+    return self.deliveries.get(delivery_id)
 
   def __repr__(self):
-    return "%s(%r, %r, %s, %s)" % (self.__class__, self.aliases, self.deliveries,
+    return "%s(%r, %r, %s, %s)" % (self.__class__, self.aliases, self.unsettled,
                                    self.unsettled_lwm, self.unsettled_hwm)
 
 class Incoming(DeliveryMap):
@@ -270,6 +335,7 @@ class Incoming(DeliveryMap):
       self.window += 1
 
   def mark(self, transfer):
+    transfer.delivery_id = Serial(transfer.delivery_id)
     if self.unsettled_lwm is None:
       self.unsettled_lwm = transfer.delivery_id
     else:
@@ -278,8 +344,8 @@ class Incoming(DeliveryMap):
 
 class Outgoing(DeliveryMap):
 
-  initial_delivery = 1
-  initial_transfer = 1
+  initial_delivery = SERIAL_START + 1
+  initial_transfer = SERIAL_START + 1
 
   def init(self):
     self.unsettled_lwm = self.initial_delivery
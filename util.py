@@ -17,7 +17,9 @@
 # under the License.
 #
 
-import os, sys, mllib, traceback, time
+import inspect, os, sys, mllib, traceback, time
+from bisect import bisect_right
+from collections import deque
 
 __SELF__ = object()
 
@@ -35,32 +37,213 @@ class Constant:
 
 class InsufficientCapacity(Exception): pass
 
+class Exhausted(Exception): pass
+
+# A Buffer holds the bytes written to it as a deque of chunks, along
+# with how much of the first chunk has already been consumed, so both
+# writing and consuming are O(1) and nothing is copied until a
+# contiguous peek, read, or view spans more than one chunk. Chunks may
+# be strs or memoryviews.
+#
+# Without a pause callback writing beyond capacity raises
+# InsufficientCapacity. With one capacity is a high watermark instead:
+# pause is called once the buffer holds capacity bytes or more, and
+# resume once it drains back down to low (by default half of capacity).
+
+class Watermark:
+
+  def __init__(self, high, low=None, pause=None, resume=None):
+    self.high = high
+    if low is None:
+      low = high/2
+    self.low = low
+    self.pause = pause
+    self.resume = resume
+    self.paused = False
+
+  def update(self, size):
+    if self.paused:
+      if size <= self.low:
+        self.paused = False
+        if self.resume is not None:
+          self.resume()
+    elif size >= self.high:
+      self.paused = True
+      if self.pause is not None:
+        self.pause()
+
+def join(segments):
+  result = bytearray()
+  for seg in segments:
+    result.extend(seg)
+  return str(result)
+
 class Buffer:
 
-  def __init__(self, bytes="", capacity=None):
-    self.bytes = bytes
+  def __init__(self, bytes="", capacity=None, pause=None, resume=None,
+               low=None):
+    self.chunks = deque()
+    self.offset = 0
+    self.size = 0
     self.capacity = capacity
+    if pause is None:
+      self.watermark = None
+    else:
+      self.watermark = Watermark(capacity, low, pause, resume)
+    if bytes:
+      self.chunks.append(bytes)
+      self.size = len(bytes)
 
   def read(self, n=None):
-    if n is None:
-      n = len(self.bytes)
-    result = self.bytes[:n]
-    self.bytes = self.bytes[n:]
+    result = self.peek(n)
+    self.consume(len(result))
     return result
 
+  def contiguous(self, n):
+    first = self.chunks[0]
+    if len(first) - self.offset < n:
+      # join just the leading chunks we need and keep the result so we
+      # don't join them again next time
+      parts = [memoryview(first)[self.offset:]]
+      total = len(first) - self.offset
+      self.chunks.popleft()
+      while total < n:
+        chunk = self.chunks.popleft()
+        parts.append(chunk)
+        total += len(chunk)
+      first = join(parts)
+      self.chunks.appendleft(first)
+      self.offset = 0
+    return first
+
   def peek(self, n=None):
-    if n is None:
-      return self.bytes
+    if n is None or n > self.size:
+      n = self.size
+    if not n:
+      return ""
+    first = self.contiguous(n)
+    if isinstance(first, memoryview):
+      return first[self.offset:self.offset + n].tobytes()
+    elif self.offset == 0 and len(first) == n:
+      return first
     else:
-      return self.bytes[:n]
+      return first[self.offset:self.offset + n]
+
+  def view(self, n=None):
+    if n is None or n > self.size:
+      n = self.size
+    if not n:
+      return memoryview("")
+    first = self.contiguous(n)
+    return memoryview(first)[self.offset:self.offset + n]
+
+  def gather(self, limit=None, count=None):
+    # leading chunks holding no more than limit bytes, though always at
+    # least one
+    result = []
+    total = 0
+    for chunk in self.chunks:
+      if result and (limit is not None and total + len(chunk) > limit or
+                     count is not None and len(result) >= count):
+        break
+      if not result and self.offset:
+        chunk = memoryview(chunk)[self.offset:]
+      result.append(chunk)
+      total += len(chunk)
+    return result
 
-  def write(self, bytes):
-    if self.capacity and len(self.bytes) + len(bytes) > self.capacity:
+  def consume(self, n):
+    self.size -= n
+    while n > 0:
+      left = len(self.chunks[0]) - self.offset
+      if left <= n:
+        self.chunks.popleft()
+        self.offset = 0
+        n -= left
+      else:
+        self.offset += n
+        n = 0
+    if self.watermark is not None:
+      self.watermark.update(self.size)
+
+  def reserve(self, size):
+    if self.capacity and self.watermark is None and \
+          self.size + size > self.capacity:
       raise InsufficientCapacity()
-    self.bytes += bytes
+
+  def filled(self):
+    if self.watermark is not None:
+      self.watermark.update(self.size)
+
+  def write(self, bytes):
+    self.reserve(len(bytes))
+    if bytes:
+      self.chunks.append(bytes)
+      self.size += len(bytes)
+      self.filled()
+
+  def extend(self, segments):
+    size = sum([len(seg) for seg in segments])
+    self.reserve(size)
+    for seg in segments:
+      if len(seg):
+        self.chunks.append(seg)
+    self.size += size
+    self.filled()
 
   def pending(self):
-    return len(self.bytes)
+    return self.size
+
+# Endpoints dispatch each body they receive through a table mapping
+# the body's class to the handler for it, so a frame costs one dict
+# lookup per layer rather than building a "do_<name>" string and a
+# getattr. Each endpoint class gets its own table, filled in the first
+# time a body class shows up: a handler registered for that endpoint
+# class (or any of its bases) and body class wins, otherwise its
+# do_<name> method is used, otherwise the default, if any. Handlers are
+# called unbound, with the endpoint as their first argument.
+
+TABLES = {}
+HANDLERS = {}
+
+class DispatchTable(dict):
+
+  def __init__(self, cls, default=None):
+    dict.__init__(self)
+    self.cls = cls
+    self.default = default
+
+  def __missing__(self, type):
+    handler = self.resolve(type)
+    self[type] = handler
+    return handler
+
+  def resolve(self, type):
+    for cls in inspect.getmro(self.cls):
+      registered = HANDLERS.get(cls)
+      if registered:
+        for base in inspect.getmro(type):
+          if base in registered:
+            return registered[base]
+    name = "do_%s" % type.NAME
+    if self.default is not None and not hasattr(self.cls, name):
+      name = self.default
+    handler = getattr(self.cls, name)
+    return getattr(handler, "im_func", handler)
+
+def dispatch_table(cls, default=None):
+  try:
+    return TABLES[cls]
+  except KeyError:
+    table = DispatchTable(cls, default)
+    TABLES[cls] = table
+    return table
+
+def register(cls, type, handler):
+  HANDLERS.setdefault(cls, {})[type] = handler
+  # anything already resolved may have been for a subclass of cls
+  for table in TABLES.values():
+    table.clear()
 
 def parse(state):
   while True:
@@ -91,36 +274,119 @@ def decode_numeric_desc(descriptor):
 def identity(x):
   return x
 
+# the most we hand the socket at once
+SEND_LIMIT = 256*1024
+SEND_SEGMENTS = 64
+# how long output is held for when coalescing, unless told otherwise
+COALESCE_DELAY = 1000
+
+# Output is written as soon as there is any unless coalesce is set, in
+# which case it is held until there are at least coalesce bytes or the
+# oldest of it has waited delay microseconds (COALESCE_DELAY if not
+# given), whichever comes first. A delay of 0 writes everything straight
+# away, just as if coalesce weren't set.
+#
+# Everything timed is scheduled on the selector's timers: the period
+# handler, the flush deadline, and the heartbeats that keep the
+# connection inside the idle timeout the peer asked for.
+
 class ConnectionSelectable:
 
-  def __init__(self, socket, connection, tick, period=None, timeout=lambda c: None):
+  def __init__(self, socket, connection, tick, period=None, timeout=lambda c: None,
+               coalesce=0, delay=None):
     self.socket = socket
+    # sendmsg writes every segment in one go, without it we join them
+    self.sendmsg = getattr(socket, "sendmsg", None)
     self.connection = connection
     self.tick = tick
     self.period = period
     self._timeout = timeout
-    if self.period:
-      self._timing = 0
-    else:
-      self._timing = None
+    self.selector = None
+    self._period_timer = None
+    self.coalesce = coalesce
+    if delay is None:
+      delay = COALESCE_DELAY
+    self.delay = delay
+    self._flushing = None
+    self._flush_timer = None
+    # when we last wrote anything
+    self._sent = time.time()
+    self._heartbeat_timer = None
+    # number of sends, and how many of them wrote up to each power of
+    # two bytes
+    self.sends = 0
+    self.batches = {}
 
   def fileno(self):
     return self.socket.fileno()
 
-  def timing(self):
-    return self._timing
+  def registered(self, selector):
+    self.selector = selector
+    if self.period:
+      self._period_timer = selector.schedule(time.time(), self.timeout)
 
-  def timeout(self, selector):
-    self._timing = time.time() + self.period
+  def timeout(self):
+    self._period_timer = self.selector.schedule(time.time() + self.period,
+                                                self.timeout)
     self._timeout(self.connection)
 
+  def flush(self):
+    # nothing to do, being woken is enough for writing to see the
+    # deadline has passed
+    pass
+
+  def flushed(self):
+    self._flushing = None
+    if self._flush_timer is not None:
+      self._flush_timer.cancel()
+      self._flush_timer = None
+
+  def heartbeat(self):
+    idle = self.connection.idle()
+    if idle is None or self.socket is None:
+      self._heartbeat_timer = None
+      return
+    interval = idle/2.0
+    now = time.time()
+    if now - self._sent >= interval:
+      self.connection.heartbeat()
+      next = now + interval
+    else:
+      next = self._sent + interval
+    self._heartbeat_timer = self.selector.schedule(next, self.heartbeat)
+
   def reading(self):
     return self.socket is not None
 
   def writing(self):
     if self.socket is None: return False
     self.tick(self.connection)
-    return self.connection.pending()
+    pending = self.connection.pending()
+    if not pending:
+      self.flushed()
+      return False
+    elif pending >= self.coalesce:
+      return True
+    else:
+      now = time.time()
+      if self._flushing is None:
+        self._flushing = now + self.delay/1000000.0
+        self._flush_timer = self.selector.schedule(self._flushing, self.flush)
+      return now >= self._flushing
+
+  def stats(self):
+    batches = ", ".join(["<=%s: %s" % (k, self.batches[k])
+                         for k in sorted(self.batches)])
+    return "sends=%s batches={%s}" % (self.sends, batches)
+
+  def close(self, selector):
+    self.connection.trace("io", "CLOSED: %s", self.stats())
+    for timer in (self._period_timer, self._flush_timer, self._heartbeat_timer):
+      if timer is not None:
+        timer.cancel()
+    selector.unregister(self)
+    self.socket.close()
+    self.socket = None
 
   def readable(self, selector):
     # XXX: hardcoded buffer size
@@ -139,29 +405,149 @@ class ConnectionSelectable:
         if bytes:
           self.connection.write(bytes)
           self.tick(self.connection)
+          if self._heartbeat_timer is None and self.connection.idle():
+            self.heartbeat()
           return
         else:
           self.connection.closed()
           self.tick(self.connection)
       except:
         self.connection.trace("err", traceback.format_exc().strip())
-    selector.unregister(self)
-    self.socket.close()
-    self.socket = None
+    self.close(selector)
 
   def writeable(self, selector):
     try:
-      n = self.socket.send(self.connection.peek())
-      bytes = self.connection.read(n)
+      segments = self.connection.segments(SEND_LIMIT, SEND_SEGMENTS)
+      if self.sendmsg is not None:
+        n = self.sendmsg(segments)
+      elif len(segments) == 1:
+        n = self.socket.send(segments[0])
+      else:
+        n = self.socket.send(join(segments))
+      self.sends += 1
+      bucket = 1 << max(0, n - 1).bit_length()
+      self.batches[bucket] = self.batches.get(bucket, 0) + 1
+      # anything left over from a partial write is already due
+      if n == sum([len(seg) for seg in segments]):
+        self.flushed()
+      if n:
+        self._sent = time.time()
+      self.connection.consume(n)
       return
     except:
       cls, exc, tb = sys.exc_info()
       self.connection.trace("err", "".join(traceback.format_exception(cls, exc, tb)).strip())
       self.connection.error(exc)
       self.tick(self.connection)
-    selector.unregister(self)
-    self.socket.close()
-    self.socket = None
+    self.close(selector)
+
+# RFC1982 serial numbers for the 32 bit delivery ids, transfer numbers
+# and delivery counts. A Serial stays within 32 bits and orders against
+# another Serial modulo 2**32, so it keeps working as the counter wraps.
+# Adding or subtracting a plain int steps the number, subtracting a
+# Serial gives the signed distance between the two. Comparisons with a
+# plain int are ordinary int comparisons, so wire values need to be
+# made into Serials before they are compared.
+
+SERIAL_BITS = 32
+SERIAL_MASK = (1 << SERIAL_BITS) - 1
+SERIAL_HALF = 1 << (SERIAL_BITS - 1)
+
+class Serial(int):
+
+  def __new__(cls, value):
+    return int.__new__(cls, value & SERIAL_MASK)
+
+  def __add__(self, n):
+    return Serial(int(self) + n)
+
+  __radd__ = __add__
+
+  def __sub__(self, n):
+    if isinstance(n, Serial):
+      return self.distance(n)
+    else:
+      return Serial(int(self) - n)
+
+  def __rsub__(self, n):
+    return Serial(n).distance(self)
+
+  def distance(self, other):
+    d = (int(self) - int(other)) & SERIAL_MASK
+    if d >= SERIAL_HALF:
+      d -= SERIAL_MASK + 1
+    return d
+
+  def __lt__(self, o):
+    if isinstance(o, Serial):
+      return self.distance(o) < 0
+    else:
+      return int(self) < o
+
+  def __le__(self, o):
+    if isinstance(o, Serial):
+      return self.distance(o) <= 0
+    else:
+      return int(self) <= o
+
+  def __gt__(self, o):
+    if isinstance(o, Serial):
+      return self.distance(o) > 0
+    else:
+      return int(self) > o
+
+  def __ge__(self, o):
+    if isinstance(o, Serial):
+      return self.distance(o) >= 0
+    else:
+      return int(self) >= o
+
+  __hash__ = int.__hash__
+
+# Setting AMQP_SERIAL_START starts every session and link counter at
+# that value rather than zero, e.g. 4294967200 runs across the wrap.
+SERIAL_START = Serial(int(os.environ.get("AMQP_SERIAL_START", 0)))
+
+# An Allocator hands out the ids from 0 up to max, reusing freed ones
+# before any it hasn't handed out yet, and raises Exhausted once none
+# are left. Both allocating and freeing are O(1). The max may be
+# lowered at any time, e.g. once the peer's limit is known, and freed
+# ids above it are then skipped.
+
+class Allocator:
+
+  def __init__(self, max):
+    self.max = max
+    self.next = 0
+    self.free = []
+    self.used = set()
+
+  def limit(self, max):
+    if max is not None:
+      self.max = min(self.max, max)
+
+  def allocate(self):
+    while self.free:
+      id = self.free.pop()
+      if id <= self.max:
+        break
+    else:
+      if self.next > self.max:
+        raise Exhausted("all ids up to %s are in use" % self.max)
+      id = self.next
+      self.next += 1
+    self.used.add(id)
+    return id
+
+  def release(self, id):
+    self.used.remove(id)
+    self.free.append(id)
+
+  def __len__(self):
+    return len(self.used)
+
+  def __repr__(self):
+    return "Allocator(%s, %s)" % (self.max, len(self.used))
 
 class Range:
 
@@ -207,41 +593,76 @@ class Range:
   def __repr__(self):
     return "%s-%s" % (self.lower, self.upper)
 
+# A RangeSet keeps its ranges sorted and disjoint, with no two of them
+# adjacent, alongside a list of their lower bounds so that finding the
+# ranges touching a value is a bisect.
+
 class RangeSet:
 
   def __init__(self, *args):
     self.ranges = []
+    self.lowers = []
     for n in args:
       self.add(n)
 
   def __contains__(self, n):
-    for r in self.ranges:
-      if n in r:
-        return True
-    return False
+    idx = bisect_right(self.lowers, n) - 1
+    return idx >= 0 and n <= self.ranges[idx].upper
+
+  # index of the first range with an upper bound of at least n
+  def _first(self, n):
+    idx = bisect_right(self.lowers, n) - 1
+    if idx < 0:
+      return 0
+    elif self.ranges[idx].upper < n:
+      return idx + 1
+    else:
+      return idx
 
   def add_range(self, range):
-    idx = 0
-    while idx < len(self.ranges):
-      r = self.ranges[idx]
-      if range.touches(r):
-        del self.ranges[idx]
-        range = range.span(r)
-      elif range.upper < r.lower:
-        self.ranges.insert(idx, range)
-        return
-      else:
-        idx += 1
-    self.ranges.append(range)
+    lower = range.lower
+    upper = range.upper
+    # everything from the first range reaching lower - 1 to the last
+    # range starting at upper + 1 merges into one
+    start = self._first(lower - 1)
+    end = bisect_right(self.lowers, upper + 1)
+    if start < end:
+      lower = min(lower, self.ranges[start].lower)
+      upper = max(upper, self.ranges[end - 1].upper)
+      range = Range(lower, upper)
+    self.ranges[start:end] = [range]
+    self.lowers[start:end] = [lower]
 
   def add(self, lower, upper = None):
     self.add_range(Range(lower, upper))
 
+  def remove_range(self, range):
+    start = self._first(range.lower)
+    end = bisect_right(self.lowers, range.upper)
+    pieces = []
+    if start < end:
+      first = self.ranges[start]
+      last = self.ranges[end - 1]
+      if first.lower < range.lower:
+        pieces.append(Range(first.lower, range.lower - 1))
+      if last.upper > range.upper:
+        pieces.append(Range(range.upper + 1, last.upper))
+    self.ranges[start:end] = pieces
+    self.lowers[start:end] = [r.lower for r in pieces]
+
+  def remove(self, lower, upper = None):
+    self.remove_range(Range(lower, upper))
+
+  def between(self, lower, upper):
+    # the parts of our ranges that lie between lower and upper
+    idx = self._first(lower)
+    while idx < len(self.ranges) and self.ranges[idx].lower <= upper:
+      r = self.ranges[idx]
+      yield Range(max(lower, r.lower), min(upper, r.upper))
+      idx += 1
+
   def empty(self):
-    for r in self.ranges:
-      if r.lower <= r.upper:
-        return False
-    return True
+    return not self.ranges
 
   def max(self):
     if self.ranges: